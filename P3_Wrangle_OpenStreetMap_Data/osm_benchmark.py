@@ -0,0 +1,743 @@
+# coding: utf-8
+
+"""
+Synthetic OSM data and benchmarks for the wrangling pipeline.
+
+    python osm_benchmark.py suite [size MB ...]
+
+generates seeded synthetic maps of 10 MB, 100 MB and 1 GB (or the sizes given)
+and times count_tags, the cell 2-4 audits, process_map, load_map and the cell 7
+report on each, every stage in a fresh process with its peak RSS. Results are
+appended to benchmark_results.jsonl and the suite fails if a stage got slower
+or bigger than the median of its recent runs on the same machine. Runs that
+regressed are stored flagged failed and never count towards that median.
+
+    python osm_benchmark.py memory
+
+generates OSM files of increasing size and runs the streaming reader, the
+audits and process_map over each one in a fresh process. It fails if peak RSS
+goes over the ceiling or grows with the size of the file.
+
+    python osm_benchmark.py queries
+
+loads a synthetic file into the original cell 6 schema and into the indexed
+osm_db schema, times every cell 7 query and the consolidated osm_report
+against both and checks from EXPLAIN QUERY PLAN that the indexed schema never
+falls back to a table scan.
+
+    python osm_benchmark.py shaping
+
+times shape_element per element and measures the memory held by shaped rows.
+
+    python osm_benchmark.py writing
+
+measures the share of process_map spent writing the csv files.
+
+    python osm_benchmark.py spatial
+
+times bounding box, radius and nearest neighbour queries of osm_spatial on
+files of increasing size against a scan of nodes, and fails if the indexed
+latency grows anywhere near as fast as the number of nodes.
+
+    python osm_benchmark.py geometry
+
+times the bulk way geometry of osm_geometry against a SQL join of ways_nodes
+and nodes with the lengths summed in Python, and checks both agree.
+
+    python osm_benchmark.py sampling
+
+samples a synthetic file with both samplers of osm_sample and fails if the
+seeking sampler reads more than a share of the file or is slower than the
+full scan of sample_by_id.
+
+    python osm_benchmark.py columnar
+
+writes the tables as csv and as Parquet, compares their sizes and times the
+value counts of one key in nodes_tags read back from each.
+"""
+
+from __future__ import print_function
+
+import os
+import random
+import re
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import timeit
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+## Values seen in the Melbourne extract, used to give the synthetic tags a realistic shape
+USERS = ['Leon K', 'AlexOnTheBus', 'melb_guy', 'BlueMM', 'Gagravarr', 'ashmcd', 'wambacher', 'Canley']
+NODE_TAGS = [
+    ('amenity', ['cafe', 'restaurant', 'bench', 'parking', 'toilets', 'bank', 'fast_food']),
+    ('name', ['Thornbury', 'Flinders Street', 'Southern Cross', 'Brunswick']),
+    ('addr:street', ['Smith Street', 'Sydney Road', 'High St', 'Chapel Street']),
+    ('addr:state', ['Victoria', 'VIC']),
+    ('source', ['survey', 'yahoo', 'bing', 'Bing']),
+    ('highway', ['bus_stop', 'traffic_signals', 'crossing']),
+]
+WAY_TAGS = [
+    ('highway', ['residential', 'service', 'footway', 'primary', 'secondary', 'tertiary']),
+    ('name', ['Smith Street', 'Sydney Road', 'High Street', 'Chapel Street']),
+    ('building', ['yes', 'house', 'residential']),
+    ('source', ['survey', 'yahoo', 'bing']),
+    ('oneway', ['yes', 'no']),
+]
+
+NODE_TEMPLATE = ('  <node id="%d" lat="%.7f" lon="%.7f" timestamp="2016-10-12T01:57:17Z" '
+                 'uid="%d" user="%s" version="%d" changeset="%d"')
+WAY_TEMPLATE = ('  <way id="%d" timestamp="2015-12-12T20:13:09Z" uid="%d" user="%s" '
+                'version="%d" changeset="%d">\n')
+
+
+def skewed_choice(rng, values):
+    """ Picks from values with a long tail: the first ones are the most common, as in real tag values. """
+    return values[int(len(values) * rng.random() ** 2)]
+
+
+def _write_tags(out, rng, choices, n):
+    for key, values in rng.sample(choices, n):
+        out.write('    <tag k="%s" v="%s" />\n' % (key, skewed_choice(rng, values)))
+
+
+def generate_osm(path, size_bytes, seed=0):
+    """
+    Writes a synthetic OSM file of roughly size_bytes to path. Nodes come first,
+    then ways referencing them, then relations, the same order as a real extract.
+    Users and tag values follow long tailed distributions. The same seed always
+    produces the same file. Returns the number of nodes, ways and relations.
+    """
+    rng = random.Random(seed)
+    node_budget = size_bytes * 6 // 10
+    way_budget = size_bytes * 95 // 100
+    node_id = 1000000
+    way_id = 5000000
+
+    with open(path, 'w') as out:
+        out.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        out.write('<osm version="0.6" generator="osm_benchmark">\n')
+        out.write('  <bounds minlat="-38.0" minlon="144.5" maxlat="-37.5" maxlon="145.5"/>\n')
+
+        while out.tell() < node_budget:
+            node_id += 1
+            uid = USERS.index(skewed_choice(rng, USERS))
+            out.write(NODE_TEMPLATE % (node_id, rng.uniform(-38.0, -37.5), rng.uniform(144.5, 145.5),
+                                       uid + 1000, USERS[uid], rng.randint(1, 12), rng.randint(1, 50000000)))
+            ## Most nodes are bare way vertices, a few carry tags
+            n_tags = rng.choice((0, 0, 0, 0, 1, 2, 3))
+            if n_tags:
+                out.write('>\n')
+                _write_tags(out, rng, NODE_TAGS, n_tags)
+                out.write('  </node>\n')
+            else:
+                out.write('/>\n')
+
+        first_node = 1000001
+        while out.tell() < way_budget:
+            way_id += 1
+            uid = USERS.index(skewed_choice(rng, USERS))
+            out.write(WAY_TEMPLATE % (way_id, uid + 1000, USERS[uid], rng.randint(1, 12), rng.randint(1, 50000000)))
+            start = rng.randint(first_node, node_id)
+            for ref in range(start, min(start + rng.randint(2, 12), node_id + 1)):
+                out.write('    <nd ref="%d" />\n' % ref)
+            _write_tags(out, rng, WAY_TAGS, rng.randint(1, 3))
+            out.write('  </way>\n')
+
+        relation_id = 9000000
+        while out.tell() < size_bytes:
+            relation_id += 1
+            out.write('  <relation id="%d" version="1">\n' % relation_id)
+            for _ in range(rng.randint(2, 20)):
+                out.write('    <member type="way" ref="%d" role="outer" />\n' % rng.randint(5000001, way_id))
+            out.write('    <tag k="type" v="multipolygon" />\n')
+            out.write('  </relation>\n')
+
+        out.write('</osm>\n')
+
+    return {'nodes': node_id - 1000000, 'ways': way_id - 5000000, 'relations': relation_id - 9000000}
+
+
+## Code run in a fresh interpreter for each stage so ru_maxrss only covers that stage
+STAGES = {
+    'stream': 'from osm_pipeline import extract_context\n'
+              'for _ in extract_context(%(path)r): pass\n',
+    'audit': 'from osm_audit import AuditEngine, TagCounter, KeyInventory, StreetTypeAuditor\n'
+             'AuditEngine([TagCounter(), KeyInventory(), StreetTypeAuditor("addr:street")]).run(%(path)r)\n',
+    'process_map': 'from osm_pipeline import process_map\n'
+                   'process_map(%(path)r, validate=False)\n',
+}
+## Wrapped around the code of a stage, prints its wall time and peak RSS in MB
+STAGE_RUN = ('import resource, sys, timeit\n'
+             'start = timeit.default_timer()\n'
+             '%s'
+             'seconds = timeit.default_timer() - start\n'
+             'rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss\n'
+             'print("%%f %%d" %% (seconds, rss // 1024 if sys.platform != "darwin" else rss // (1024 * 1024)))\n')
+
+
+def run_stage(code, path, workdir):
+    """ Runs the code of a stage over path in a new process. Returns (wall seconds, peak RSS in MB). """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(p for p in (HERE, env.get('PYTHONPATH')) if p)
+    output = subprocess.check_output([sys.executable, '-c', STAGE_RUN % (code % {'path': path})],
+                                     cwd=workdir, env=env)
+    seconds, rss = output.decode('ascii').strip().splitlines()[-1].split()
+    return float(seconds), int(rss)
+
+
+def peak_rss_mb(stage, path, workdir):
+    """ Runs one stage over path in a new process and returns its peak RSS in MB. """
+    return run_stage(STAGES[stage], path, workdir)[1]
+
+
+def check_memory(sizes_mb=(8, 64), ceiling_mb=64, slack_mb=8, seed=0):
+    """
+    Fails if any stage goes over ceiling_mb of peak RSS, or if its peak on the
+    largest file is more than slack_mb above its peak on the smallest one.
+    """
+    workdir = tempfile.mkdtemp(prefix='osm_benchmark_')
+    try:
+        peaks = {}
+        for size in sizes_mb:
+            path = os.path.join(workdir, 'synthetic_%dmb.xml' % size)
+            generate_osm(path, size * 1024 * 1024, seed=seed)
+            for stage in sorted(STAGES):
+                peaks[stage, size] = peak_rss_mb(stage, path, workdir)
+                print('%-12s %5d MB file  peak RSS %4d MB' % (stage, size, peaks[stage, size]))
+            os.remove(path)
+    finally:
+        shutil.rmtree(workdir)
+
+    failures = []
+    for stage in sorted(STAGES):
+        smallest, largest = peaks[stage, min(sizes_mb)], peaks[stage, max(sizes_mb)]
+        if largest > ceiling_mb:
+            failures.append('%s peaked at %d MB, ceiling is %d MB' % (stage, largest, ceiling_mb))
+        if largest - smallest > slack_mb:
+            failures.append('%s grew from %d MB to %d MB with file size' % (stage, smallest, largest))
+    if failures:
+        raise AssertionError('\n'.join(failures))
+    return peaks
+
+
+## Schema of the original cell 6: no keys, no indexes
+LEGACY_SCHEMA = [
+    '''CREATE TABLE nodes(id INTEGER, lat FLOAT, lon FLOAT, user TEXT, uid INTEGER, version INTEGER,
+        changeset INTEGER, timestamp TEXT)''',
+    '''CREATE TABLE nodes_tags(id INTEGER, key TEXT, value TEXT, type TEXT, FOREIGN KEY (id) REFERENCES nodes(id))''',
+    '''CREATE TABLE ways(id INTEGER, user TEXT, uid INTEGER, version INTEGER, changeset INTEGER, timestamp TEXT)''',
+    '''CREATE TABLE ways_nodes(id INTEGER, node_id INTEGER, position INTEGER)''',
+    '''CREATE TABLE ways_tags(id INTEGER, key TEXT, value TEXT, type TEXT)''',
+]
+
+## The reporting queries of cell 7
+REPORT_QUERIES = [
+    ('unique users', "SELECT COUNT(DISTINCT(uid)) FROM (SELECT uid FROM nodes UNION ALL SELECT uid FROM ways);"),
+    ('number of nodes', "SELECT COUNT(*) FROM nodes;"),
+    ('number of ways', "SELECT COUNT(*) FROM ways;"),
+    ('top ten users', "SELECT e.user, COUNT(*) as num FROM (SELECT user FROM nodes UNION ALL SELECT user FROM ways) e "
+                      "GROUP BY e.user ORDER BY num DESC LIMIT 10;"),
+]
+REPORT_KEYS = ['amenity', 'source', 'network']
+for _key in REPORT_KEYS:
+    for _table in ('nodes_tags', 'ways_tags'):
+        REPORT_QUERIES.append(('%s values in %s' % (_key, _table),
+                               "SELECT key,value, COUNT(value) FROM %s WHERE key ='%s' GROUP BY value" % (_table, _key)))
+        REPORT_QUERIES.append(('%s count in %s' % (_key, _table),
+                               "SELECT COUNT(*) FROM %s WHERE key='%s' " % (_table, _key)))
+
+## A plan step reading a whole table without any index, e.g. 'SCAN nodes_tags' or 'SCAN TABLE nodes_tags'.
+## Scans of subqueries such as 'SCAN e' in the top ten users query are fine
+TABLE_SCAN = re.compile(r'^SCAN (TABLE )?(nodes|ways|nodes_tags|ways_tags|ways_nodes)$')
+
+
+def query_plan(cur, sql):
+    return [row[-1] for row in cur.execute('EXPLAIN QUERY PLAN ' + sql)]
+
+
+def time_query(cur, sql, repeat=5):
+    """ Best wall time of repeat runs of sql, in milliseconds. """
+    return min(timeit.repeat(lambda: cur.execute(sql).fetchall(), number=1, repeat=repeat)) * 1000
+
+
+def benchmark_queries(size_mb=64, seed=0, repeat=5):
+    """
+    Times every cell 7 query against the legacy and the indexed schema loaded
+    from the same synthetic file. Fails if the indexed plan of any query still
+    scans a whole table.
+    """
+    import osm_db
+    import osm_report
+
+    workdir = tempfile.mkdtemp(prefix='osm_benchmark_')
+    try:
+        path = os.path.join(workdir, 'synthetic.xml')
+        generate_osm(path, size_mb * 1024 * 1024, seed=seed)
+        layouts = [('legacy', LEGACY_SCHEMA, []),
+                   ('indexed', osm_db.SCHEMA, osm_db.INDEXES),
+                   ('without_rowid', osm_db.WITHOUT_ROWID_SCHEMA, osm_db.WITHOUT_ROWID_INDEXES)]
+        results = {}
+        failures = []
+        for layout, schema, indexes in layouts:
+            db = os.path.join(workdir, layout + '.db')
+            osm_db.load_map(path, db, schema=schema, indexes=indexes)
+            conn = sqlite3.connect(db)
+            cur = conn.cursor()
+            for name, sql in REPORT_QUERIES:
+                plan = query_plan(cur, sql)
+                results[layout, name] = time_query(cur, sql, repeat)
+                if layout != 'legacy' and any(TABLE_SCAN.match(step) for step in plan):
+                    failures.append('%s: %s scans a whole table: %s' % (layout, name, '; '.join(plan)))
+            results[layout, 'all cell 7 queries'] = sum(results[layout, name] for name, _ in REPORT_QUERIES)
+            results[layout, 'osm_report.summarize'] = min(timeit.repeat(
+                lambda: osm_report.summarize(cur, REPORT_KEYS), number=1, repeat=repeat)) * 1000
+            conn.close()
+    finally:
+        shutil.rmtree(workdir)
+
+    print('%-28s %10s %10s %14s' % ('query (%d MB file)' % size_mb, 'legacy ms', 'indexed ms', 'no rowid ms'))
+    for name in [name for name, _ in REPORT_QUERIES] + ['all cell 7 queries', 'osm_report.summarize']:
+        print('%-28s %10.2f %10.2f %14.2f' % (name, results['legacy', name], results['indexed', name],
+                                              results['without_rowid', name]))
+    if failures:
+        raise AssertionError('\n'.join(failures))
+    return results
+
+
+def benchmark_shaping(size_mb=16, seed=0, n_elements=50000, repeat=5):
+    """
+    Micro-benchmark of shape_element on n_elements parsed up front, so the
+    parse is not part of the timing: CPU per element, and the memory blocks
+    and bytes held by the shaped rows, e.g. a batch waiting to be written.
+    """
+    import gc
+    from osm_pipeline import ET, extract_context, shape_element
+
+    workdir = tempfile.mkdtemp(prefix='osm_benchmark_')
+    try:
+        path = os.path.join(workdir, 'synthetic.xml')
+        generate_osm(path, size_mb * 1024 * 1024, seed=seed)
+        ## extract_context clears every element, so keep detached copies
+        elements = []
+        for element in extract_context(path, tags=('node', 'way')):
+            elements.append(ET.fromstring(ET.tostring(element)))
+            if len(elements) == n_elements:
+                break
+    finally:
+        shutil.rmtree(workdir)
+
+    def shape():
+        for element in elements:
+            shape_element(element)
+
+    shape_time = min(timeit.repeat(shape, number=1, repeat=repeat))
+    print('%d elements, shaping %.2f us per element' % (len(elements), shape_time / len(elements) * 1e6))
+
+    if hasattr(sys, 'getallocatedblocks'):
+        import tracemalloc
+        gc.collect()
+        blocks = sys.getallocatedblocks()
+        tracemalloc.start()
+        rows = [shape_element(element) for element in elements]
+        gc.collect()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        blocks = sys.getallocatedblocks() - blocks
+        print('shaped rows hold %.1f memory blocks and %.0f bytes per element'
+              % (blocks / float(len(rows)), size / float(len(rows))))
+
+
+def benchmark_writing(size_mb=32, seed=0, repeat=3, compressions=(None, 'gzip')):
+    """
+    Share of process_map spent writing csv: parse + shape alone against the
+    full write to csv files, for each compression.
+    """
+    import osm_pipeline
+
+    workdir = tempfile.mkdtemp(prefix='osm_benchmark_')
+    try:
+        path = os.path.join(workdir, 'synthetic.xml')
+        generate_osm(path, size_mb * 1024 * 1024, seed=seed)
+        paths = [os.path.join(workdir, table) for _, table, _ in osm_pipeline.TABLES]
+
+        def shape():
+            for element in osm_pipeline.extract_context(path, tags=('node', 'way')):
+                osm_pipeline.shape_element(element)
+
+        shape_time = min(timeit.repeat(shape, number=1, repeat=repeat))
+        print('parse + shape       %6.2f s' % shape_time)
+        for compression in compressions:
+            write_time = min(timeit.repeat(lambda: osm_pipeline.write_elements(path, paths, compression=compression),
+                                           number=1, repeat=repeat))
+            print('write %-13s %6.2f s, csv writing is %2.0f%% of it'
+                  % (compression or 'plain csv', write_time, 100 * (write_time - shape_time) / write_time))
+    finally:
+        shutil.rmtree(workdir)
+
+
+## Area covered by generate_osm, see its <bounds>
+BOUNDS = (-38.0, 144.5, -37.5, 145.5)
+## Nodes expected in each bbox and radius query, the searched area shrinks as the files grow
+QUERY_HITS = 50
+## The same bbox without the spatial index
+SCAN_BBOX = 'SELECT id, lat, lon FROM nodes WHERE lat BETWEEN ? AND ? AND lon BETWEEN ? AND ?'
+
+
+def benchmark_spatial(sizes_mb=(4, 16, 64), seed=0, n_queries=200):
+    """
+    Mean latency of the osm_spatial queries at n_queries random points for each
+    file size. Fails if the indexed latency grows by more than half the growth
+    in nodes between the smallest and the largest file.
+    """
+    import osm_db
+    import osm_spatial
+
+    min_lat, min_lon, max_lat, max_lon = BOUNDS
+    rng = random.Random(seed)
+    points = [(rng.uniform(min_lat, max_lat), rng.uniform(min_lon, max_lon)) for _ in range(n_queries)]
+
+    def mean_ms(query):
+        start = timeit.default_timer()
+        for lat, lon in points:
+            query(lat, lon)
+        return (timeit.default_timer() - start) / len(points) * 1000
+
+    workdir = tempfile.mkdtemp(prefix='osm_benchmark_')
+    results = []
+    try:
+        for size_mb in sizes_mb:
+            path = os.path.join(workdir, 'synthetic.xml')
+            db = os.path.join(workdir, 'synthetic.db')
+            generate_osm(path, size_mb * 1024 * 1024, seed=seed)
+            osm_db.load_map(path, db)
+            conn = sqlite3.connect(db)
+            cur = conn.cursor()
+            n_nodes = cur.execute('SELECT COUNT(*) FROM nodes').fetchone()[0]
+
+            ## Box side and radius holding QUERY_HITS nodes on average
+            side = ((max_lat - min_lat) * (max_lon - min_lon) * QUERY_HITS / n_nodes) ** 0.5
+            radius_m = side * osm_spatial.METERS_PER_DEGREE * 0.6
+
+            def box(lat, lon):
+                return lat - side / 2, lon - side / 2, lat + side / 2, lon + side / 2
+
+            timings = [
+                mean_ms(lambda lat, lon: osm_spatial.nodes_in_bbox(cur, *box(lat, lon))),
+                mean_ms(lambda lat, lon: osm_spatial.nodes_within(cur, lat, lon, radius_m)),
+                mean_ms(lambda lat, lon: osm_spatial.nearest_nodes(cur, lat, lon, 10)),
+                mean_ms(lambda lat, lon: osm_spatial.nearest_nodes(cur, lat, lon, 5, key='amenity', value='cafe')),
+            ]
+            b = box(*points[0])
+            scan = time_query(cur, SCAN_BBOX.replace('?', '%r') % (b[0], b[2], b[1], b[3]))
+            results.append((size_mb, n_nodes, timings, scan))
+            conn.close()
+            os.remove(db)
+    finally:
+        shutil.rmtree(workdir)
+
+    print('%8s %10s %10s %10s %10s %12s %10s' % ('file MB', 'nodes', 'bbox ms', 'radius ms', 'knn ms',
+                                                'cafe knn ms', 'scan ms'))
+    for size_mb, n_nodes, timings, scan in results:
+        print('%8d %10d %10.3f %10.3f %10.3f %12.3f %10.3f' % ((size_mb, n_nodes) + tuple(timings) + (scan,)))
+
+    (_, first_nodes, first, _), (_, last_nodes, last, _) = results[0], results[-1]
+    node_growth = last_nodes / float(first_nodes)
+    failures = ['%s latency grew %.1fx for %.1fx the nodes' % (name, b / a, node_growth)
+                for name, a, b in zip(('bbox', 'radius', 'knn', 'cafe knn'), first, last)
+                if b / a > node_growth / 2]
+    if failures:
+        raise AssertionError('\n'.join(failures))
+    return results
+
+
+## Coordinates of every way reference in order, the per row alternative to osm_geometry
+WAY_POINTS = ('SELECT wn.id, n.lat, n.lon FROM ways_nodes wn JOIN nodes n ON n.id = wn.node_id '
+              'ORDER BY wn.id, wn.position')
+
+
+def benchmark_geometry(size_mb=256, seed=0):
+    """
+    Time of build_way_geometry on a synthetic file against summing the way
+    lengths row by row over a join in SQL. Fails if the lengths differ.
+    """
+    import osm_db
+    import osm_geometry
+    from osm_spatial import haversine_m
+
+    workdir = tempfile.mkdtemp(prefix='osm_benchmark_')
+    try:
+        path = os.path.join(workdir, 'synthetic.xml')
+        db = os.path.join(workdir, 'synthetic.db')
+        generate_osm(path, size_mb * 1024 * 1024, seed=seed)
+        osm_db.load_map(path, db, spatial=False)
+        conn = sqlite3.connect(db)
+        cur = conn.cursor()
+
+        start = timeit.default_timer()
+        metrics = osm_geometry.build_way_geometry(cur)
+        conn.commit()
+        bulk_time = timeit.default_timer() - start
+
+        start = timeit.default_timer()
+        lengths = {}
+        previous = None
+        for way_id, lat, lon in cur.execute(WAY_POINTS):
+            if previous is not None and previous[0] == way_id:
+                lengths[way_id] = lengths.get(way_id, 0.0) + haversine_m(previous[1], previous[2], lat, lon)
+            previous = (way_id, lat, lon)
+        row_time = timeit.default_timer() - start
+
+        bulk = dict(cur.execute('SELECT id, length_m FROM ways_geometry'))
+        conn.close()
+    finally:
+        shutil.rmtree(workdir)
+
+    print('%d ways, %d node references, %d missing' % (metrics['ways'], metrics['refs'], metrics['missing_refs']))
+    print('osm_geometry, lengths and areas   %6.2f s' % bulk_time)
+    print('SQL join + Python, lengths only   %6.2f s' % row_time)
+    wrong = [way_id for way_id, length in lengths.items() if abs(bulk[way_id] - length) > 1e-6 * max(1.0, length)]
+    if wrong:
+        raise AssertionError('%d way lengths differ, e.g. way %d' % (len(wrong), wrong[0]))
+    return metrics, bulk_time, row_time
+
+
+def benchmark_columnar(size_mb=64, seed=0, key='amenity', repeat=3):
+    """
+    File sizes of the csv and the Parquet output, and the time to count the
+    values of key in nodes_tags from each: csv.reader over the whole file
+    against reading the key and value columns of the rows with that key.
+    Fails if the two counts differ.
+    """
+    import csv
+    from collections import Counter
+    import pyarrow.compute
+    import pyarrow.parquet
+    import osm_pipeline
+
+    workdir = tempfile.mkdtemp(prefix='osm_benchmark_')
+    cwd = os.getcwd()
+    try:
+        path = os.path.join(workdir, 'synthetic.xml')
+        generate_osm(path, size_mb * 1024 * 1024, seed=seed)
+        os.chdir(workdir)
+        formats = [('csv', None), ('csv', 'gzip'), ('parquet', None), ('parquet', 'zstd')]
+        for output_format, compression in formats:
+            start = timeit.default_timer()
+            osm_pipeline.process_map(path, False, compression=compression, output_format=output_format)
+            write_time = timeit.default_timer() - start
+            size = sum(os.path.getsize(p) for p in osm_pipeline.output_paths(compression, output_format))
+            print('%-8s %-6s written in %5.2f s, %6.1f MB' % (output_format, compression or '', write_time,
+                                                              size / 1048576.0))
+
+        def from_csv():
+            with open('nodes_tags.csv') as f:
+                return Counter(row[2] for row in csv.reader(f) if row[1] == key)
+
+        def from_parquet():
+            table = pyarrow.parquet.read_table('nodes_tags.parquet', columns=['key', 'value'])
+            values = table.column('value').filter(pyarrow.compute.equal(table.column('key'), key))
+            return dict((item['values'], item['counts']) for item in values.value_counts().to_pylist())
+
+        csv_time = min(timeit.repeat(from_csv, number=1, repeat=repeat))
+        parquet_time = min(timeit.repeat(from_parquet, number=1, repeat=repeat))
+        same = dict(from_csv()) == from_parquet()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+
+    print('%s values in nodes_tags: csv %.3f s, Parquet %.3f s, %.0fx faster'
+          % (key, csv_time, parquet_time, csv_time / parquet_time))
+    if not same:
+        raise AssertionError('csv and Parquet value counts differ')
+    return csv_time, parquet_time
+
+
+def benchmark_sampling(size_mb=256, seed=0, fraction=0.01, max_read_share=0.15):
+    """
+    Times sample_blocks and sample_by_id on a synthetic file of size_mb. Fails
+    if sample_blocks reads more than max_read_share of the file, is not faster
+    than sample_by_id, or leaves way references without their node.
+    """
+    import osm_sample
+
+    workdir = tempfile.mkdtemp(prefix='osm_benchmark_')
+    try:
+        path = os.path.join(workdir, 'synthetic.xml')
+        generate_osm(path, size_mb * 1024 * 1024, seed=seed)
+        size = os.path.getsize(path)
+        out = os.path.join(workdir, 'sample.xml')
+        start = timeit.default_timer()
+        blocks = osm_sample.sample_blocks(path, out, fraction=fraction, seed=seed)
+        blocks_time = timeit.default_timer() - start
+        start = timeit.default_timer()
+        by_id = osm_sample.sample_by_id(path, out, fraction, seed=seed)
+        by_id_time = timeit.default_timer() - start
+    finally:
+        shutil.rmtree(workdir)
+
+    read_share = blocks['bytes_read'] / float(size)
+    print('sample_blocks %.2f s, read %.1f MB (%.1f%% of the file), %d nodes %d ways'
+          % (blocks_time, blocks['bytes_read'] / 1048576.0, 100 * read_share, blocks['nodes'], blocks['ways']))
+    print('sample_by_id  %.2f s, read the whole %d MB, %d nodes %d ways'
+          % (by_id_time, size_mb, by_id['nodes'], by_id['ways']))
+    failures = []
+    if read_share > max_read_share:
+        failures.append('sample_blocks read %.1f%% of the file, limit %.1f%%' % (100 * read_share, 100 * max_read_share))
+    if blocks_time >= by_id_time:
+        failures.append('sample_blocks took %.2f s, the full scan %.2f s' % (blocks_time, by_id_time))
+    if blocks['missing_refs'] or by_id['missing_refs']:
+        failures.append('samples left way references without their node')
+    if failures:
+        raise AssertionError('\n'.join(failures))
+    return blocks_time, by_id_time, blocks['bytes_read']
+
+
+## The keys audited in cell 2
+AUDIT_KEYS = ['addr:country', 'postal_code', 'exit_to', 'addr:city', 'addr:postcode', 'amenity', 'addr:state']
+
+## Suite: file sizes, and the stages of the notebook in the order they run.
+## load_map leaves suite.db behind for the report
+SUITE_SIZES_MB = (10, 100, 1024)
+SUITE_STAGES = [
+    ('count_tags', 'from osm_audit import count_tags\n'
+                   'count_tags(%(path)r)\n'),
+    ('audit', 'from osm_audit import AuditEngine, TagCounter, KeyInventory, StreetTypeAuditor\n'
+              'engine = AuditEngine([TagCounter(), KeyInventory()])\n'
+              'for key in %r:\n'
+              '    engine.register(StreetTypeAuditor(key))\n'
+              'engine.run(%%(path)r)\n' % (AUDIT_KEYS,)),
+    ('process_map', 'from osm_pipeline import process_map\n'
+                    'process_map(%(path)r, validate=False)\n'),
+    ('load_map', 'from osm_db import load_map\n'
+                 'load_map(%(path)r, "suite.db")\n'),
+    ('report', 'import sqlite3\n'
+               'from osm_report import summarize\n'
+               'summarize(sqlite3.connect("suite.db").cursor(), %r)\n' % (REPORT_KEYS,)),
+]
+
+RESULTS_PATH = os.path.join(HERE, 'benchmark_results.jsonl')
+## A stage regresses when it is this much slower than its baseline, or uses this much more memory
+TIME_TOLERANCE = 0.25
+RSS_TOLERANCE = 0.25
+RSS_SLACK_MB = 8
+## Baseline: median of the last runs of a stage on the same machine and Python
+BASELINE_RUNS = 5
+
+
+def environment():
+    """ What a result can only be compared against: the machine, the Python and the commit. """
+    import platform
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE,
+                                         stderr=subprocess.STDOUT).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'machine': platform.node(), 'python': platform.python_version(), 'commit': commit}
+
+
+def load_results(path=RESULTS_PATH):
+    import json
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def baseline(history, env, stage, size_mb, runs=BASELINE_RUNS):
+    """
+    Median seconds and peak RSS of the last runs of stage on the same machine
+    and Python, or None. Runs that regressed are left out, so a slowdown
+    never becomes the baseline.
+    """
+    past = [r for r in history if r['stage'] == stage and r['size_mb'] == size_mb and not r.get('failed')
+            and r['machine'] == env['machine'] and r['python'] == env['python']][-runs:]
+    if not past:
+        return None
+    median = lambda values: sorted(values)[len(values) // 2]
+    return median([r['seconds'] for r in past]), median([r['peak_rss_mb'] for r in past])
+
+
+def run_suite(sizes_mb=SUITE_SIZES_MB, seed=0, results_path=RESULTS_PATH, save=True):
+    """
+    Times every stage of SUITE_STAGES on a synthetic file of each size and
+    compares it with its baseline from results_path. The new results are
+    appended to results_path unless save is False, those that regressed
+    flagged failed. Fails on any regression.
+    """
+    import datetime
+    import json
+
+    env = environment()
+    history = load_results(results_path)
+    run_at = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+    results = []
+    workdir = tempfile.mkdtemp(prefix='osm_benchmark_')
+    try:
+        for size_mb in sizes_mb:
+            path = os.path.join(workdir, 'synthetic_%dmb.xml' % size_mb)
+            counts = generate_osm(path, size_mb * 1024 * 1024, seed=seed)
+            n_elements = counts['nodes'] + counts['ways'] + counts['relations']
+            file_mb = os.path.getsize(path) / 1048576.0
+            for stage, code in SUITE_STAGES:
+                seconds, rss = run_stage(code, path, workdir)
+                result = dict(env, run_at=run_at, seed=seed, stage=stage, size_mb=size_mb, seconds=seconds,
+                              mb_per_s=file_mb / seconds, elements_per_s=n_elements / seconds, peak_rss_mb=rss)
+                result['baseline'] = baseline(history, env, stage, size_mb)
+                results.append(result)
+            os.remove(path)
+    finally:
+        shutil.rmtree(workdir)
+
+    print('%-12s %8s %9s %8s %11s %8s %12s' % ('stage', 'file MB', 'seconds', 'MB/s', 'elements/s', 'RSS MB',
+                                                'vs baseline'))
+    failures = []
+    for r in results:
+        change = ''
+        r['failed'] = False
+        if r['baseline'] is not None:
+            base_seconds, base_rss = r['baseline']
+            change = '%+.0f%% time' % (100 * (r['seconds'] / base_seconds - 1))
+            if r['seconds'] > base_seconds * (1 + TIME_TOLERANCE):
+                failures.append('%s on %d MB took %.2f s, baseline %.2f s'
+                                % (r['stage'], r['size_mb'], r['seconds'], base_seconds))
+                r['failed'] = True
+            if r['peak_rss_mb'] > max(base_rss * (1 + RSS_TOLERANCE), base_rss + RSS_SLACK_MB):
+                failures.append('%s on %d MB peaked at %d MB, baseline %d MB'
+                                % (r['stage'], r['size_mb'], r['peak_rss_mb'], base_rss))
+                r['failed'] = True
+        print('%-12s %8d %9.2f %8.2f %11.0f %8d %12s' % (r['stage'], r['size_mb'], r['seconds'], r['mb_per_s'],
+                                                        r['elements_per_s'], r['peak_rss_mb'], change))
+
+    if save:
+        with open(results_path, 'a') as f:
+            for r in results:
+                f.write(json.dumps(dict((k, v) for k, v in r.items() if k != 'baseline'), sort_keys=True) + '\n')
+    if failures:
+        raise AssertionError('\n'.join(failures))
+    return results
+
+
+COMMANDS = {
+    'columnar': benchmark_columnar,
+    'geometry': benchmark_geometry,
+    'memory': check_memory,
+    'queries': benchmark_queries,
+    'sampling': benchmark_sampling,
+    'shaping': benchmark_shaping,
+    'spatial': benchmark_spatial,
+    'suite': run_suite,
+    'writing': benchmark_writing,
+}
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else 'memory'
+    if command not in COMMANDS:
+        sys.exit('usage: python osm_benchmark.py [%s]' % '|'.join(sorted(COMMANDS)))
+    if command == 'suite' and len(sys.argv) > 2:
+        run_suite(sizes_mb=[int(size) for size in sys.argv[2:]])
+    else:
+        COMMANDS[command]()
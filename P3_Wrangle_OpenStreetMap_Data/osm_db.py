@@ -0,0 +1,256 @@
+# coding: utf-8
+
+"""
+Loading of shaped OSM elements into the SQLite database (mydv.db).
+
+load_map() streams elements from shape_element straight into the tables in
+bounded batches inside a single transaction, so the csv files are not needed
+and no table is ever held in memory as a whole.
+
+apply_changes() brings an existing database up to date from an osmChange
+(.osc) diff instead. Created and modified elements are shaped and cleaned the
+same way and replace the stored rows, deleted ones are removed, all in one
+transaction. Its cost follows the size of the diff, not of the map.
+"""
+
+import sqlite3
+
+from osm_pipeline import (extract_context, extract_changes, shape_element, CHANGE_ACTIONS, NODE_FIELDS,
+                          NODE_TAGS_FIELDS, WAY_FIELDS, WAY_TAGS_FIELDS, WAY_NODES_FIELDS)
+from osm_rules import CLEANING_RULES
+from osm_spatial import create_spatial_index
+
+## Tables loaded from shape_element: (shaped element key, table, fields)
+TABLES = [
+    ('node', 'nodes', NODE_FIELDS),
+    ('node_tags', 'nodes_tags', NODE_TAGS_FIELDS),
+    ('way', 'ways', WAY_FIELDS),
+    ('way_nodes', 'ways_nodes', WAY_NODES_FIELDS),
+    ('way_tags', 'ways_tags', WAY_TAGS_FIELDS),
+]
+
+## Typed schema. nodes and ways are keyed on their OSM id, ways_nodes on (id, position)
+SCHEMA = [
+    '''CREATE TABLE nodes(id INTEGER PRIMARY KEY, lat REAL NOT NULL, lon REAL NOT NULL, user TEXT,
+        uid INTEGER, version INTEGER, changeset INTEGER, timestamp TEXT)''',
+    '''CREATE TABLE nodes_tags(id INTEGER NOT NULL, key TEXT NOT NULL, value TEXT, type TEXT NOT NULL,
+        FOREIGN KEY (id) REFERENCES nodes(id))''',
+    '''CREATE TABLE ways(id INTEGER PRIMARY KEY, user TEXT, uid INTEGER, version INTEGER,
+        changeset INTEGER, timestamp TEXT)''',
+    '''CREATE TABLE ways_nodes(id INTEGER NOT NULL, node_id INTEGER NOT NULL, position INTEGER NOT NULL,
+        PRIMARY KEY (id, position), FOREIGN KEY (id) REFERENCES ways(id)) WITHOUT ROWID''',
+    '''CREATE TABLE ways_tags(id INTEGER NOT NULL, key TEXT NOT NULL, value TEXT, type TEXT NOT NULL,
+        FOREIGN KEY (id) REFERENCES ways(id))''',
+]
+
+## Created once the bulk insert is done, building them row by row is much slower.
+## (key, value) covers the per key GROUP BY value reports, (user, uid) the user counts
+INDEXES = [
+    'CREATE INDEX nodes_user ON nodes(user, uid)',
+    'CREATE INDEX ways_user ON ways(user, uid)',
+    'CREATE INDEX nodes_tags_id ON nodes_tags(id)',
+    'CREATE INDEX nodes_tags_key_value ON nodes_tags(key, value)',
+    'CREATE INDEX ways_tags_id ON ways_tags(id)',
+    'CREATE INDEX ways_tags_key_value ON ways_tags(key, value)',
+]
+
+## Alternative layout storing the tag tables clustered on (id, type, key). It saves
+## the rowid and the id index, but needs every (id, type, key) to be unique, which
+## holds for valid OSM data where a k value appears at most once per element
+WITHOUT_ROWID_SCHEMA = SCHEMA[:1] + [
+    '''CREATE TABLE nodes_tags(id INTEGER NOT NULL, key TEXT NOT NULL, value TEXT, type TEXT NOT NULL,
+        PRIMARY KEY (id, type, key), FOREIGN KEY (id) REFERENCES nodes(id)) WITHOUT ROWID''',
+] + SCHEMA[2:4] + [
+    '''CREATE TABLE ways_tags(id INTEGER NOT NULL, key TEXT NOT NULL, value TEXT, type TEXT NOT NULL,
+        PRIMARY KEY (id, type, key), FOREIGN KEY (id) REFERENCES ways(id)) WITHOUT ROWID''',
+]
+WITHOUT_ROWID_INDEXES = [index for index in INDEXES if not index.endswith('_tags(id)')]
+
+## The database is rebuilt from scratch on every load, so durability can be traded for speed
+LOAD_PRAGMAS = [
+    'PRAGMA journal_mode = MEMORY',
+    'PRAGMA synchronous = OFF',
+    'PRAGMA cache_size = -65536',
+    'PRAGMA temp_store = MEMORY',
+]
+
+BATCH_SIZE = 10000
+
+
+def insert_statement(table, fields):
+    return 'INSERT INTO %s(%s) VALUES(%s);' % (table, ','.join(fields), ','.join('?' * len(fields)))
+
+
+## Tables derived from the loaded ones: the spatial index of osm_spatial and the
+## way geometry cache of osm_geometry. Both would be stale after a new load
+DERIVED_TABLES = ['nodes_rtree', 'ways_geometry']
+
+
+def create_tables(cur, schema=SCHEMA):
+    for table in DERIVED_TABLES:
+        cur.execute('DROP TABLE IF EXISTS %s' % table)
+    for _, table, _ in TABLES:
+        cur.execute('DROP TABLE IF EXISTS %s' % table)
+    for create in schema:
+        cur.execute(create)
+
+
+def create_indexes(cur, indexes=INDEXES):
+    for index in indexes:
+        cur.execute(index)
+    ## Give the query planner statistics on the new indexes
+    cur.execute('ANALYZE')
+
+
+def rollback(cur):
+    """ Rolls back the open transaction, if the failure left one open. """
+    try:
+        cur.execute('ROLLBACK')
+    except sqlite3.OperationalError:
+        pass
+
+
+class BatchInserter(object):
+    """ Buffers rows per table and inserts them with executemany once batch_size rows are pending. """
+
+    def __init__(self, cur, batch_size=BATCH_SIZE):
+        self.cur = cur
+        self.batch_size = batch_size
+        self.pending = 0
+        self.statements = {}
+        self.rows = {}
+        for key, table, fields in TABLES:
+            self.statements[key] = insert_statement(table, fields)
+            self.rows[key] = []
+
+    def add(self, key, rows):
+        ## shape_element rows are already tuples in the order of the table's fields
+        self.rows[key].extend(rows)
+        self.pending += len(rows)
+        if self.pending >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        for key, rows in self.rows.items():
+            if rows:
+                self.cur.executemany(self.statements[key], rows)
+                del rows[:]
+        self.pending = 0
+
+
+def load_map(file_in, sqlite_file, batch_size=BATCH_SIZE, schema=SCHEMA, indexes=INDEXES, spatial=True):
+    """
+    Rebuilds the tables of sqlite_file from the OSM file file_in. Rows go
+    straight from shape_element into the database, batch_size rows at a time,
+    and the indexes are created after the bulk insert, with the nodes_rtree
+    spatial index of osm_spatial unless spatial is False. Pass
+    WITHOUT_ROWID_SCHEMA and WITHOUT_ROWID_INDEXES for the clustered tag tables.
+    The hits of CLEANING_RULES count this load only.
+    """
+    CLEANING_RULES.reset()
+    conn = sqlite3.connect(sqlite_file)
+    ## Transactions are managed explicitly so the whole load is a single one
+    conn.isolation_level = None
+    cur = conn.cursor()
+    try:
+        for pragma in LOAD_PRAGMAS:
+            cur.execute(pragma)
+
+        cur.execute('BEGIN')
+        create_tables(cur, schema)
+        inserter = BatchInserter(cur, batch_size)
+        for element in extract_context(file_in, tags=('node', 'way')):
+            el = shape_element(element)
+            if el:
+                if element.tag == 'node':
+                    inserter.add('node', [el['node']])
+                    inserter.add('node_tags', el['node_tags'])
+                elif element.tag == 'way':
+                    inserter.add('way', [el['way']])
+                    inserter.add('way_nodes', el['way_nodes'])
+                    inserter.add('way_tags', el['way_tags'])
+        inserter.flush()
+        if spatial:
+            create_spatial_index(cur)
+        create_indexes(cur, indexes)
+        cur.execute('COMMIT')
+    except Exception:
+        rollback(cur)
+        raise
+    finally:
+        conn.close()
+
+
+## Tables holding each element type: (element table, [(shaped element key, child table)])
+ELEMENT_TABLES = {
+    'node': ('nodes', [('node_tags', 'nodes_tags')]),
+    'way': ('ways', [('way_nodes', 'ways_nodes'), ('way_tags', 'ways_tags')]),
+}
+
+
+class ChangeApplier(object):
+    """
+    Applies changed elements batch_size at a time. Within a batch only the last
+    change of an element counts, which keeps the file order of the diff while
+    every table is touched with one executemany per batch.
+    """
+
+    def __init__(self, cur, batch_size=BATCH_SIZE):
+        self.cur = cur
+        self.batch_size = batch_size
+        self.inserter = BatchInserter(cur, batch_size)
+        ## (tag, id) -> shaped element, or None once deleted
+        self.changes = {}
+        self.counts = dict((action, 0) for action in CHANGE_ACTIONS)
+
+    def add(self, action, element):
+        self.counts[action] += 1
+        key = (element.tag, int(element.attrib['id']))
+        self.changes[key] = None if action == 'delete' else shape_element(element)
+        if len(self.changes) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        for tag, (table, children) in ELEMENT_TABLES.items():
+            ids = [(element_id,) for (t, element_id) in self.changes if t == tag]
+            if not ids:
+                continue
+            ## Old rows of every changed element go, the new ones are inserted afresh
+            for _, child in children:
+                self.cur.executemany('DELETE FROM %s WHERE id = ?' % child, ids)
+            self.cur.executemany('DELETE FROM %s WHERE id = ?' % table, ids)
+            for (t, _), el in self.changes.items():
+                if t == tag and el is not None:
+                    self.inserter.add(tag, [el[tag]])
+                    for key, _ in children:
+                        self.inserter.add(key, el[key])
+        self.inserter.flush()
+        self.changes.clear()
+
+
+def apply_changes(osc_file, sqlite_file, batch_size=BATCH_SIZE):
+    """
+    Updates the tables of sqlite_file, as built by load_map, with the nodes and
+    ways of the osmChange file osc_file. Returns the number of elements per
+    action. Relations are skipped, like in load_map, and the ways_geometry
+    cache of osm_geometry is dropped. Nothing is applied if any part of the
+    diff fails.
+    """
+    conn = sqlite3.connect(sqlite_file)
+    conn.isolation_level = None
+    cur = conn.cursor()
+    try:
+        cur.execute('BEGIN')
+        applier = ChangeApplier(cur, batch_size)
+        for action, element in extract_changes(osc_file, tags=('node', 'way')):
+            applier.add(action, element)
+        applier.flush()
+        ## Moved nodes change the geometry of ways that are not in the diff, so the cache goes
+        cur.execute('DROP TABLE IF EXISTS ways_geometry')
+        cur.execute('COMMIT')
+    except Exception:
+        rollback(cur)
+        raise
+    finally:
+        conn.close()
+    return applier.counts
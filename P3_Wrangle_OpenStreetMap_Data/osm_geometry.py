@@ -0,0 +1,131 @@
+# coding: utf-8
+
+"""
+Way geometry of mydv.db, computed in bulk with NumPy.
+
+build_way_geometry() reads the node coordinates and the ways_nodes references
+once, both already sorted on their keys, and joins them with searchsorted
+instead of a lookup per row. Segment lengths are haversine distances and the
+area of a closed way is the shoelace formula on a local projection, all as
+array operations. The results are cached in the ways_geometry table:
+
+    id, nodes, missing_nodes, length_m, area_m2, closed
+
+Ways referencing nodes that are not in the database keep the length of their
+known segments and get no area, and the number of such references is returned
+as a data quality metric. apply_changes() drops the cache, rebuild it after.
+"""
+
+import numpy as np
+
+from osm_spatial import EARTH_RADIUS_M
+
+GEOMETRY_SCHEMA = '''CREATE TABLE ways_geometry(id INTEGER PRIMARY KEY, nodes INTEGER NOT NULL,
+    missing_nodes INTEGER NOT NULL, length_m REAL NOT NULL, area_m2 REAL, closed INTEGER NOT NULL)'''
+
+NODE_DTYPE = np.dtype([('id', np.int64), ('lat', np.float64), ('lon', np.float64)])
+REF_DTYPE = np.dtype([('id', np.int64), ('node_id', np.int64)])
+
+
+def read_nodes(cur):
+    """ Node ids, latitudes and longitudes as arrays sorted on id. """
+    nodes = np.fromiter(cur.execute('SELECT id, lat, lon FROM nodes ORDER BY id'), dtype=NODE_DTYPE)
+    return nodes['id'], nodes['lat'], nodes['lon']
+
+
+def read_way_refs(cur):
+    """ Way ids and node references in way order, then position order. """
+    refs = np.fromiter(cur.execute('SELECT id, node_id FROM ways_nodes ORDER BY id, position'), dtype=REF_DTYPE)
+    return refs['id'], refs['node_id']
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """ Great circle distances in metres between arrays of points given in degrees. """
+    lat1, lon1, lat2, lon2 = (np.radians(a) for a in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def join_coordinates(node_ids, lat, lon, refs):
+    """
+    Coordinates of every reference in refs, by binary search of the sorted
+    node_ids. Returns (lat, lon, found), with NaN where the node is missing.
+    """
+    if not len(node_ids):
+        nan = np.full(len(refs), np.nan)
+        return nan, nan, np.zeros(len(refs), dtype=bool)
+    index = np.minimum(np.searchsorted(node_ids, refs), len(node_ids) - 1)
+    found = node_ids[index] == refs
+    return np.where(found, lat[index], np.nan), np.where(found, lon[index], np.nan), found
+
+
+def way_geometry(node_ids, lat, lon, way_ids, refs):
+    """
+    Geometry of every way from sorted node arrays and the references of
+    read_way_refs. Returns a dict of per way arrays: id, nodes, missing_nodes,
+    length_m, area_m2 (NaN unless the way is closed and complete) and closed.
+    """
+    ref_lat, ref_lon, found = join_coordinates(node_ids, lat, lon, refs)
+
+    ## Each way is a run of equal ids, starts[i] is the first reference of way i.
+    ## The slices only matter without any reference at all
+    starts = np.flatnonzero(np.r_[True, way_ids[1:] != way_ids[:-1]])[:len(way_ids)]
+    ends = np.r_[starts[1:], len(way_ids)][:len(starts)]
+    way_index = np.repeat(np.arange(len(starts)), ends - starts)
+    n_ways = len(starts)
+
+    missing = np.bincount(way_index, weights=~found, minlength=n_ways).astype(np.int64)
+
+    ## Segments join consecutive references of the same way, those touching a missing node are left out
+    same_way = way_index[1:] == way_index[:-1]
+    segment = same_way & found[1:] & found[:-1]
+    lengths = haversine(ref_lat[:-1][segment], ref_lon[:-1][segment], ref_lat[1:][segment], ref_lon[1:][segment])
+    length = np.bincount(way_index[:-1][segment], weights=lengths, minlength=n_ways).astype(np.float64)
+
+    ## Closed ways: same first and last node and at least a triangle
+    closed = (refs[starts] == refs[ends - 1]) & (ends - starts >= 4)
+
+    ## Shoelace on an equirectangular projection around each way's first node
+    area = np.full(n_ways, np.nan)
+    polygon = closed & (missing == 0)
+    if polygon.any():
+        origin = starts[way_index]
+        cos_lat = np.cos(np.radians(ref_lat[origin]))
+        x = np.radians(ref_lon - ref_lon[origin]) * cos_lat * EARTH_RADIUS_M
+        y = np.radians(ref_lat - ref_lat[origin]) * EARTH_RADIUS_M
+        cross = np.where(same_way, x[:-1] * y[1:] - x[1:] * y[:-1], 0.0)
+        twice_area = np.bincount(way_index[:-1], weights=np.nan_to_num(cross), minlength=n_ways)
+        area[polygon] = np.abs(twice_area[polygon]) / 2
+
+    return {'id': way_ids[starts], 'nodes': ends - starts, 'missing_nodes': missing,
+            'length_m': length, 'area_m2': area, 'closed': closed}
+
+
+def build_way_geometry(cur):
+    """
+    (Re)builds the ways_geometry table of the database behind cur. Returns the
+    data quality metrics: ways, references, missing references and ways with
+    at least one missing node.
+    """
+    node_ids, lat, lon = read_nodes(cur)
+    way_ids, refs = read_way_refs(cur)
+    geometry = way_geometry(node_ids, lat, lon, way_ids, refs)
+
+    area = geometry['area_m2'].astype(object)
+    area[np.isnan(geometry['area_m2'])] = None
+    rows = zip(geometry['id'].tolist(), geometry['nodes'].tolist(), geometry['missing_nodes'].tolist(),
+               geometry['length_m'].tolist(), area.tolist(), geometry['closed'].astype(int).tolist())
+    cur.execute('DROP TABLE IF EXISTS ways_geometry')
+    cur.execute(GEOMETRY_SCHEMA)
+    cur.executemany('INSERT INTO ways_geometry VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+    return {'ways': len(geometry['id']), 'refs': len(refs),
+            'missing_refs': int(geometry['missing_nodes'].sum()),
+            'ways_missing_nodes': int((geometry['missing_nodes'] > 0).sum())}
+
+
+def length_by_tag(cur, key='highway'):
+    """ (value, number of ways, total length in metres) per value of a way tag, longest first. """
+    return cur.execute('SELECT t.value, COUNT(*), SUM(g.length_m) FROM ways_geometry g '
+                       'JOIN ways_tags t ON t.id = g.id AND t.key = ? '
+                       'GROUP BY t.value ORDER BY SUM(g.length_m) DESC', (key,)).fetchall()
@@ -0,0 +1,654 @@
+# coding: utf-8
+
+"""
+Shaping of OSM XML into the five csv files loaded into mydv.db.
+
+With output_format='parquet' the same tables are written as typed Parquet
+files instead, see ParquetTableWriter.
+
+process_map() runs serially by default. With workers > 1 the file is split into
+byte ranges aligned on <node>/<way>/<relation> boundaries, every range is shaped
+in a process pool into its own part files, and the parts are merged back in file
+order so the output is byte identical to the serial run.
+"""
+
+import csv
+import gzip
+import io
+import os
+import re
+import shutil
+import sys
+from multiprocessing import Pool
+from operator import itemgetter
+
+try:
+    from functools import lru_cache
+except ImportError:
+    lru_cache = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import xml.etree.cElementTree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
+
+from osm_profile import PipelineProfile
+from osm_rules import CLEANING_RULES
+
+PY2 = sys.version_info[0] == 2
+
+## Set name for csv files to which XML data will be exported
+NODES_PATH = "nodes.csv"
+NODE_TAGS_PATH = "nodes_tags.csv"
+WAYS_PATH = "ways.csv"
+WAY_NODES_PATH = "ways_nodes.csv"
+WAY_TAGS_PATH = "ways_tags.csv"
+
+## Search for colon (:) and problemchars
+LOWER_COLON = re.compile(r'^([a-z]|_)+:([a-z]|_)+')
+PROBLEMCHARS = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
+
+## Set which keys/values will be extracted from tag
+NODE_FIELDS = ['id', 'lat', 'lon', 'user', 'uid', 'version', 'changeset', 'timestamp']
+NODE_TAGS_FIELDS = ['id', 'key', 'value', 'type']
+WAY_FIELDS = ['id', 'user', 'uid', 'version', 'changeset', 'timestamp']
+WAY_TAGS_FIELDS = ['id', 'key', 'value', 'type']
+WAY_NODES_FIELDS = ['id', 'node_id', 'position']
+
+## Output tables in the order they are written: (shaped element key, path, fields)
+TABLES = [
+    ('node', NODES_PATH, NODE_FIELDS),
+    ('node_tags', NODE_TAGS_PATH, NODE_TAGS_FIELDS),
+    ('way', WAYS_PATH, WAY_FIELDS),
+    ('way_nodes', WAY_NODES_PATH, WAY_NODES_FIELDS),
+    ('way_tags', WAY_TAGS_PATH, WAY_TAGS_FIELDS),
+]
+
+## Start of a main tag. Attribute values are escaped so '<' only ever opens an element
+ELEMENT_START = re.compile(br'<(?:node|way|relation)[\s/>]')
+SCAN_SIZE = 1 << 20
+
+
+## Function for iterating through the main tags
+def extract_context(osm_file, tags=('node', 'way', 'relation'), on_root=None):
+    """
+    Yields the main tags of osm_file in constant memory. Every top level element
+    is cleared once the caller is done with it, whether or not it was yielded,
+    so its tag/nd children and all preceding siblings are freed as the file
+    streams. tags=None yields every top level element. on_root, if given, is
+    called with the root element before anything is yielded.
+    """
+    ## Get elements from start to end
+    context_1 = iter(ET.iterparse(osm_file, events=('start','end')))
+    _, root = next(context_1)
+    if on_root is not None:
+        on_root(root)
+
+    depth = 1
+    for event,elem in context_1:
+        if event == 'start':
+            depth += 1
+            continue
+
+        depth -= 1
+        if depth == 1:
+            if tags is None or elem.tag in tags:
+                yield elem
+            elem.clear()
+            root.clear()
+
+
+## Actions of an osmChange file
+CHANGE_ACTIONS = ('create', 'modify', 'delete')
+
+
+def extract_changes(osc_file, tags=('node', 'way', 'relation')):
+    """
+    Yields (action, element) for every element of the osmChange file osc_file,
+    in file order, in constant memory like extract_context. Elements sit one
+    level deeper than in an OSM file, inside <create>, <modify> or <delete>.
+    """
+    context_1 = iter(ET.iterparse(osc_file, events=('start','end')))
+    _, root = next(context_1)
+
+    depth = 1
+    block = None
+    for event,elem in context_1:
+        if event == 'start':
+            depth += 1
+            if depth == 2:
+                block = elem
+            continue
+
+        depth -= 1
+        if depth == 2:
+            if block.tag in CHANGE_ACTIONS and elem.tag in tags:
+                yield block.tag, elem
+            ## A single <create> can hold most of the file, so drop finished children
+            block.clear()
+        elif depth == 1:
+            elem.clear()
+            root.clear()
+
+
+## Bounded caches for the shaping path. A city has a few hundred distinct k values
+## but millions of tags, and many values and user names repeat over and over
+KEY_CACHE_SIZE = 4096
+INTERN_SIZE = 1 << 16
+
+
+def memoize(func, maxsize=KEY_CACHE_SIZE):
+    """ LRU cache of at most maxsize results, Python 2 gets a dictionary emptied when full. """
+    if lru_cache is not None:
+        return lru_cache(maxsize=maxsize)(func)
+
+    cache = {}
+    def cached(*args):
+        try:
+            return cache[args]
+        except KeyError:
+            if len(cache) >= maxsize:
+                cache.clear()
+            result = cache[args] = func(*args)
+            return result
+    return cached
+
+
+## Shared copies of repeated strings, so values like 'yes' or a user name are not
+## kept as thousands of separate objects. Unlike intern() on Python 2 this works on
+## unicode too. shape_element empties the table once it holds INTERN_SIZE strings,
+## which keeps memory bounded on any file
+_interned = {}
+intern_string = _interned.setdefault
+
+
+## Splits a k value into (key, type) e.g. addr:street -> (street, addr)
+def _split_key(k, default_tag_type):
+    tag_type, colon, key = k.partition(':')
+    if not colon:
+        return intern_string(k, k), default_tag_type
+    return intern_string(key, key), intern_string(tag_type, tag_type)
+
+split_key = memoize(_split_key)
+is_problem_key = memoize(lambda k: PROBLEMCHARS.match(k) is not None)
+
+
+## Clean up any inconsistency found through querying or earlier through trial and error checking
+## The fixes themselves are the rules in cleaning_rules.json, see osm_rules
+## Returns a (id, key, value, type) tuple with the new cleaned data
+def clean_tag(element,secondary,default_tag_type,rules=CLEANING_RULES):
+    attrib = secondary.attrib
+    key, tag_type = split_key(attrib['k'], default_tag_type)
+    value = attrib['v']
+    if key in rules.rules:
+        value = rules.clean(key, value)
+    return (element.attrib['id'], key, intern_string(value, value), tag_type)
+
+
+## Rows buffered per table before they are serialized and written in one go
+BUFFER_ROWS = 8192
+
+## Optional compression of the csv output: name -> file name suffix
+COMPRESSION_SUFFIXES = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+
+OUTPUT_FORMATS = ('csv', 'parquet')
+
+
+def open_output(path, compression=None):
+    """ Opens path for binary writing, through a gzip or zstd compressor if asked to. """
+    if compression not in COMPRESSION_SUFFIXES:
+        raise ValueError('Unknown compression %r, use one of %s' % (compression, sorted(COMPRESSION_SUFFIXES)))
+    if compression == 'gzip':
+        ## mtime=0 keeps the output identical from run to run
+        return gzip.GzipFile(path, 'wb', mtime=0)
+    if compression == 'zstd':
+        if zstandard is None:
+            raise ValueError('zstd output needs the zstandard package')
+        return zstandard.ZstdCompressor().stream_writer(open(path, 'wb'))
+    return open(path, 'wb')
+
+
+class BufferedCSVWriter(object):
+    """
+    csv writer for the shaped row tuples of one table. Rows are collected and
+    every buffer_rows of them are serialized with a single writerows call into
+    an in-memory buffer, encoded to utf-8 once and written to the binary stream
+    in one write.
+    """
+
+    def __init__(self, stream, fieldnames, buffer_rows=BUFFER_ROWS):
+        self.stream = stream
+        self.fieldnames = fieldnames
+        self.buffer_rows = buffer_rows
+        self.rows = []
+        self.buffer = io.BytesIO() if PY2 else io.StringIO(newline='')
+        self.writer = csv.writer(self.buffer)
+
+    def writeheader(self):
+        self.rows.append(self.fieldnames)
+
+    def writerow(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.buffer_rows:
+            self.flush()
+
+    def writerows(self, rows):
+        self.rows.extend(rows)
+        if len(self.rows) >= self.buffer_rows:
+            self.flush()
+
+    def flush(self):
+        rows = self.rows
+        if PY2:
+            rows = [[v.encode('utf-8') if isinstance(v, unicode) else v for v in row] for row in rows]
+        self.writer.writerows(rows)
+        data = self.buffer.getvalue()
+        self.stream.write(data if PY2 else data.encode('utf-8'))
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        self.rows = []
+
+
+## Parquet output: rows per row group, and the codec used for each compression
+## name. Parquet is compressed column by column anyway, None picks snappy
+ROW_GROUP_ROWS = 1 << 16
+PARQUET_CODECS = {None: 'snappy', 'gzip': 'gzip', 'zstd': 'zstd'}
+PARQUET_SUFFIX = '.parquet'
+
+## Column types of the Parquet output. Columns with few distinct values are
+## dictionary encoded so they also come back as categories
+COLUMN_TYPES = {
+    'id': 'int64', 'node_id': 'int64', 'position': 'int32',
+    'lat': 'float64', 'lon': 'float64',
+    'user': 'dictionary', 'uid': 'int64', 'version': 'int32', 'changeset': 'int64', 'timestamp': 'timestamp',
+    'key': 'dictionary', 'value': 'string', 'type': 'dictionary',
+}
+
+
+def _require_pyarrow():
+    """
+    Imports pyarrow on first use: it takes tens of MB and a noticeable time to
+    load, which csv runs and the modules importing this one should not pay.
+    """
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ValueError('Parquet output needs the pyarrow package')
+    return pyarrow
+
+
+def arrow_type(name):
+    pyarrow = _require_pyarrow()
+    type_name = COLUMN_TYPES[name]
+    if type_name == 'dictionary':
+        return pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+    if type_name == 'timestamp':
+        ## Parquet has no second unit, ms is the coarsest that reads back unchanged
+        return pyarrow.timestamp('ms', tz='UTC')
+    return getattr(pyarrow, type_name)()
+
+
+class ParquetTableWriter(object):
+    """
+    Writer for the shaped row tuples of one table with the interface of
+    BufferedCSVWriter. Every row_group_rows rows are converted column by column
+    to their types in COLUMN_TYPES and written as one row group, so memory is
+    bounded by a row group whatever the size of the input.
+    """
+
+    def __init__(self, path, fieldnames, compression=None, row_group_rows=ROW_GROUP_ROWS):
+        pyarrow = _require_pyarrow()
+        if compression not in PARQUET_CODECS:
+            raise ValueError('Unknown compression %r, use one of %s' % (compression, sorted(PARQUET_CODECS)))
+        self.fieldnames = fieldnames
+        self.row_group_rows = row_group_rows
+        self.rows = []
+        self.pyarrow = pyarrow
+        self.schema = pyarrow.schema([(name, arrow_type(name)) for name in fieldnames])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema, compression=PARQUET_CODECS[compression])
+
+    def writeheader(self):
+        ## The column names are part of the schema
+        pass
+
+    def writerow(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.row_group_rows:
+            self.flush()
+
+    def writerows(self, rows):
+        self.rows.extend(rows)
+        if len(self.rows) >= self.row_group_rows:
+            self.flush()
+
+    def write_table(self, table):
+        self.writer.write_table(table)
+
+    def flush(self):
+        if not self.rows:
+            return
+        ## Attribute values are strings, the casts parse them in C
+        pyarrow = self.pyarrow
+        columns = [pyarrow.array(column).cast(field.type) for column, field in zip(zip(*self.rows), self.schema)]
+        self.writer.write_table(pyarrow.Table.from_arrays(columns, schema=self.schema))
+        self.rows = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+def attrib_shaper(fields):
+    """
+    Returns a function turning an element's attributes into a tuple in the order
+    of fields. A missing attribute becomes None, and the user name is interned.
+    """
+    getter = itemgetter(*fields)
+    user = fields.index('user') if 'user' in fields else None
+
+    def shape(element):
+        attrib = element.attrib
+        try:
+            row = getter(attrib)
+        except KeyError:
+            row = tuple([attrib.get(f) for f in fields])
+        if user is not None and row[user] is not None:
+            row = row[:user] + (intern_string(row[user], row[user]),) + row[user + 1:]
+        return row
+    return shape
+
+_shape_node_attribs = attrib_shaper(NODE_FIELDS)
+_shape_way_attribs = attrib_shaper(WAY_FIELDS)
+
+
+def _shape_tags(element, problem_chars, default_tag_type):
+    tags = []
+    for secondary in element.iter('tag'):
+        k = secondary.attrib['k']
+        if problem_chars is PROBLEMCHARS:
+            problem = is_problem_key(k)
+        else:
+            problem = problem_chars.match(k) is not None
+        if not problem:
+            ## Using clean_tag to make sure data is cleaned up
+            tags.append(clean_tag(element, secondary, default_tag_type))
+    return tags
+
+
+## Iterates through the parent tag e.g. node and gets all wanted attributes
+## Every row is a tuple in the order of the matching *_FIELDS list
+def shape_element(element,node_attr_fields=NODE_FIELDS,way_attr_fields=WAY_FIELDS,problem_chars=PROBLEMCHARS,
+                 default_tag_type='regular'):
+
+    if len(_interned) > INTERN_SIZE:
+        _interned.clear()
+
+    ## Getting attributes in node tags
+    if element.tag == "node":
+        shape_attribs = _shape_node_attribs if node_attr_fields is NODE_FIELDS else attrib_shaper(node_attr_fields)
+        return {'node': shape_attribs(element),
+                'node_tags': _shape_tags(element, problem_chars, default_tag_type)}
+
+    ## Getting attributes in way tags
+    if element.tag=="way":
+        way_id = element.attrib['id']
+        way_nodes = [(way_id, nd.attrib['ref'], position) for position, nd in enumerate(element.iter('nd'))]
+        shape_attribs = _shape_way_attribs if way_attr_fields is WAY_FIELDS else attrib_shaper(way_attr_fields)
+        return {'way': shape_attribs(element),
+                'way_nodes': way_nodes,
+                'way_tags': _shape_tags(element, problem_chars, default_tag_type)}
+
+
+def write_elements(file_in, paths, header=True, compression=None, output_format='csv', profile=None):
+    """
+    Shapes every node and way of file_in and writes them to the five csv or
+    Parquet files in paths. A PipelineProfile in profile times the parse and
+    the writers, process_map instruments the rest.
+    """
+    writers = {}
+    if output_format == 'parquet':
+        for (key, _, fields), path in zip(TABLES, paths):
+            writers[key] = ParquetTableWriter(path, fields, compression)
+        files = list(writers.values())
+    else:
+        files = [open_output(path, compression) for path in paths]
+        for (key, _, fields), f in zip(TABLES, files):
+            writers[key] = BufferedCSVWriter(f, fields)
+            if header:
+                writers[key].writeheader()
+
+    if profile is not None:
+        file_in = profile.open_input(file_in)
+        writers = profile.wrap_writers(writers)
+    try:
+        elements = extract_context(file_in, tags=('node', 'way'))
+        if profile is not None:
+            elements = profile.iter_elements(elements)
+
+        for element in elements:
+            el = shape_element(element)
+            if el:
+
+                if element.tag == 'node':
+                    writers['node'].writerow(el['node'])
+                    writers['node_tags'].writerows(el['node_tags'])
+                elif element.tag=='way':
+                    writers['way'].writerow(el['way'])
+                    writers['way_nodes'].writerows(el['way_nodes'])
+                    writers['way_tags'].writerows(el['way_tags'])
+
+        for writer in writers.values():
+            writer.flush()
+    finally:
+        for f in files:
+            f.close()
+        if profile is not None:
+            file_in.close()
+
+
+def output_paths(compression=None, output_format='csv'):
+    """ Output file of every table, e.g. nodes.csv.gz or nodes.parquet. """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError('Unknown output format %r, use one of %s' % (output_format, sorted(OUTPUT_FORMATS)))
+    if output_format == 'parquet':
+        return [os.path.splitext(path)[0] + PARQUET_SUFFIX for _, path, _ in TABLES]
+    return [path + COMPRESSION_SUFFIXES[compression] for _, path, _ in TABLES]
+
+
+## Export data to csv files, compressed with gzip or zstd if compression is given,
+## or to Parquet files with output_format='parquet'. Pass a PipelineProfile from
+## osm_profile as profile to time every stage of the run
+def process_map(file_in, validate, workers=1, compression=None, output_format='csv', profile=None):
+    paths = output_paths(compression, output_format)
+    ## Rule hits are counted per run
+    CLEANING_RULES.reset()
+    if profile is None:
+        _write_map(file_in, paths, workers, compression, output_format)
+        return
+
+    module = sys.modules[__name__]
+    originals = profile.instrument(module)
+    profile.workers = workers
+    profile.start()
+    try:
+        _write_map(file_in, paths, workers, compression, output_format, profile)
+    finally:
+        profile.stop(paths)
+        profile.restore(module, originals)
+
+
+def _write_map(file_in, paths, workers, compression, output_format, profile=None):
+    if workers <= 1:
+        write_elements(file_in, paths, compression=compression, output_format=output_format, profile=profile)
+        return
+
+    ## csv part files are written uncompressed and only the merged output is compressed.
+    ## Workers profile themselves and send back their summary
+    sampling = profile.sample_interval if profile is not None else None
+    chunks = split_osm(file_in, workers * 4)
+    jobs = [(file_in, start, end, ['%s.part%05d' % (path, i) for path in paths], output_format,
+             compression if output_format == 'parquet' else None, profile is not None, sampling)
+            for i, (start, end) in enumerate(chunks)]
+
+    pool = Pool(workers)
+    results = []
+    try:
+        for part_paths, hits, summary in pool.imap(_shape_chunk, jobs):
+            results.append((part_paths, hits))
+            if summary is not None:
+                profile.merge(summary)
+                profile.progress(sum(profile.elements.values()), profile.elapsed())
+    finally:
+        pool.close()
+        pool.join()
+
+    ## Rule hits were counted in the workers
+    for _, hits in results:
+        CLEANING_RULES.merge(hits)
+    merge_parts(paths, [part_paths for part_paths, _ in results], compression, output_format)
+
+
+## Parallel mode
+
+def find_element_start(f, offset, limit, scan_size=SCAN_SIZE):
+    """
+    Returns the offset of the first main tag at or after offset, or limit if
+    there is none, reading scan_size bytes at a time.
+    """
+    while offset < limit:
+        f.seek(offset)
+        ## Overlap the blocks so a tag split across two reads is still found
+        block = f.read(min(scan_size, limit - offset) + 16)
+        m = ELEMENT_START.search(block)
+        if m and offset + m.start() < limit:
+            return offset + m.start()
+        offset += scan_size
+    return limit
+
+
+def find_root_end(f, size):
+    """ Returns the offset of the closing </osm> tag. """
+    tail_start = max(0, size - 4096)
+    f.seek(tail_start)
+    pos = f.read().rfind(b'</osm>')
+    if pos < 0:
+        raise ValueError('No closing </osm> tag found')
+    return tail_start + pos
+
+
+def split_osm(file_in, n_chunks):
+    """
+    Splits an OSM XML file into at most n_chunks byte ranges, every one starting on
+    a <node>, <way> or <relation> tag. Returns a list of (start, end) offsets.
+    """
+    size = os.path.getsize(file_in)
+    with open(file_in, 'rb') as f:
+        root_end = find_root_end(f, size)
+        first = find_element_start(f, 0, root_end)
+        bounds = [first]
+        step = max(1, (root_end - first) // n_chunks)
+        for i in range(1, n_chunks):
+            start = find_element_start(f, max(first + i * step, bounds[-1] + 1), root_end)
+            if start >= root_end:
+                break
+            bounds.append(start)
+        bounds.append(root_end)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+class ByteRangeFile(object):
+    """ File-like object reading bytes [start, end) of a file wrapped in an <osm> root. """
+
+    def __init__(self, filename, start, end):
+        self.f = open(filename, 'rb')
+        self.f.seek(start)
+        self.remaining = end - start
+        self.head = b'<osm>'
+        self.tail = b'</osm>'
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self.head) + self.remaining + len(self.tail)
+        out = self.head[:size]
+        self.head = self.head[size:]
+        size -= len(out)
+
+        if size and self.remaining:
+            data = self.f.read(min(size, self.remaining))
+            self.remaining -= len(data)
+            size -= len(data)
+            out += data
+
+        if size and not self.remaining:
+            out += self.tail[:size]
+            self.tail = self.tail[size:]
+        return out
+
+    def close(self):
+        self.f.close()
+
+
+def _shape_chunk(job):
+    """
+    Pool worker: shapes one byte range into headerless part files. Returns them
+    with the rule hits and, if profiling, the summary of the worker's profile.
+    """
+    file_in, start, end, part_paths, output_format, compression, profiling, sampling = job
+    CLEANING_RULES.reset()
+    profile = None
+    if profiling:
+        module = sys.modules[__name__]
+        profile = PipelineProfile(progress_interval=None, sample_interval=sampling)
+        originals = profile.instrument(module)
+        profile.start()
+    source = ByteRangeFile(file_in, start, end)
+    try:
+        write_elements(source, part_paths, header=False, compression=compression, output_format=output_format,
+                       profile=profile)
+    finally:
+        source.close()
+        if profile is not None:
+            profile.stop()
+            profile.restore(module, originals)
+    return part_paths, dict(CLEANING_RULES.hits), profile.summary() if profile is not None else None
+
+
+def merge_parts(paths, parts, compression=None, output_format='csv'):
+    """ Writes a header to every output file and appends the part files in chunk order. """
+    if output_format == 'parquet':
+        merge_parquet_parts(paths, parts, compression)
+        return
+
+    for i, (path, (_, _, fields)) in enumerate(zip(paths, TABLES)):
+        out = open_output(path, compression)
+        try:
+            writer = BufferedCSVWriter(out, fields)
+            writer.writeheader()
+            writer.flush()
+            for part_paths in parts:
+                with open(part_paths[i], 'rb') as part:
+                    shutil.copyfileobj(part, out)
+                os.remove(part_paths[i])
+        finally:
+            out.close()
+
+
+def merge_parquet_parts(paths, parts, compression=None):
+    """ Copies the row groups of the Parquet part files into the output files in chunk order. """
+    pyarrow = _require_pyarrow()
+    for i, (path, (_, _, fields)) in enumerate(zip(paths, TABLES)):
+        writer = ParquetTableWriter(path, fields, compression)
+        try:
+            for part_paths in parts:
+                part = pyarrow.parquet.ParquetFile(part_paths[i])
+                for group in range(part.num_row_groups):
+                    writer.write_table(part.read_row_group(group))
+                os.remove(part_paths[i])
+        finally:
+            writer.close()
@@ -0,0 +1,308 @@
+# coding: utf-8
+
+"""
+Per stage timing and throughput of process_map.
+
+    profile = PipelineProfile()
+    process_map('Melbourne_Map_Sample.xml', validate=True, profile=profile)
+    profile.write_json('profile.json')
+
+While a profiled run is going, shape_element, clean_tag and is_problem_key of
+osm_pipeline are replaced by timed wrappers, the parsed elements and the csv
+or Parquet writers are timed as well, and a progress line goes to stderr every
+progress_interval seconds. Unprofiled runs execute the original functions, so
+profiling costs nothing when it is off.
+
+Stages are timed inclusively: clean_tag and problem_chars run inside
+shape_element. Peak RSS is that of the whole run, stages are interleaved
+element by element so they cannot be told apart. With workers > 1 the stage
+times of all workers are added up.
+
+sample_interval turns on StackSampler, a sampling profiler counting the Python
+stacks it finds every sample_interval seconds of CPU time.
+"""
+
+from __future__ import print_function
+
+import json
+import os
+import signal
+import sys
+from collections import defaultdict
+from timeit import default_timer
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+## Stages in the order they are reported
+STAGES = ('parse', 'shape_element', 'clean_tag', 'problem_chars', 'write')
+
+
+def peak_rss_mb():
+    """ Peak resident set size of this process in MB, None where it is not available. """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024.0 if sys.platform != 'darwin' else rss / 1048576.0
+
+
+def current_rss_mb():
+    """ Current resident set size in MB from /proc, the peak where there is no /proc. """
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / 1048576.0
+    except (IOError, OSError, ValueError, AttributeError):
+        return peak_rss_mb()
+
+
+class CountingFile(object):
+    """ Read-only file wrapper counting the bytes read through it. """
+
+    def __init__(self, f, profile):
+        self.f = f
+        self.profile = profile
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.profile.input_bytes += len(data)
+        return data
+
+    def close(self):
+        self.f.close()
+
+
+class TimedWriter(object):
+    """ Wraps a BufferedCSVWriter or ParquetTableWriter and times the calls into it. """
+
+    def __init__(self, writer, profile):
+        self.writer = writer
+        self.profile = profile
+
+    def _timed(self, method, *args):
+        start = default_timer()
+        method(*args)
+        self.profile.add_time('write', default_timer() - start)
+
+    def writeheader(self):
+        self._timed(self.writer.writeheader)
+
+    def writerow(self, row):
+        self._timed(self.writer.writerow, row)
+
+    def writerows(self, rows):
+        self._timed(self.writer.writerows, rows)
+
+    def flush(self):
+        self._timed(self.writer.flush)
+
+
+class StackSampler(object):
+    """
+    Sampling profiler: every interval seconds of CPU time a SIGPROF handler
+    records the current Python stack. Needs setitimer, so POSIX only, and must
+    be started from the main thread.
+    """
+
+    def __init__(self, interval=0.005):
+        if not hasattr(signal, 'setitimer'):
+            raise ValueError('Sampling needs signal.setitimer, which this platform does not have')
+        self.interval = interval
+        self.stacks = defaultdict(int)
+
+    def _sample(self, signum, frame):
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append('%s:%s' % (os.path.basename(code.co_filename), code.co_name))
+            frame = frame.f_back
+        self.stacks[';'.join(reversed(names))] += 1
+
+    def start(self):
+        self.previous = signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, self.previous)
+
+    def top(self, n=20):
+        """ (function, samples) of the n functions most often on top of the stack. """
+        leaves = defaultdict(int)
+        for stack, count in self.stacks.items():
+            leaves[stack.rsplit(';', 1)[-1]] += count
+        return sorted(leaves.items(), key=lambda item: (-item[1], item[0]))[:n]
+
+    def write_collapsed(self, path):
+        """ Writes the stacks in the collapsed format read by flamegraph.pl and speedscope. """
+        with open(path, 'w') as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write('%s %d\n' % (stack, count))
+
+
+class PipelineProfile(object):
+    """ Stage timings, element, byte and tag key counts of one process_map run. """
+
+    def __init__(self, progress_interval=5.0, stream=None, sample_interval=None):
+        self.progress_interval = progress_interval
+        self.stream = stream if stream is not None else sys.stderr
+        self.sample_interval = sample_interval
+        self.sampler = StackSampler(sample_interval) if sample_interval else None
+        self.times = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.elements = defaultdict(int)
+        self.keys = defaultdict(int)
+        self.dropped_keys = defaultdict(int)
+        self.input_bytes = 0
+        self.output_bytes = 0
+        self.wall = 0.0
+        self.workers = 1
+        self.peak_rss = None
+        self.worker_peak_rss = None
+
+    def add_time(self, stage, seconds):
+        self.times[stage] += seconds
+        self.calls[stage] += 1
+
+    def _timed(self, stage, func, count=None):
+        add_time = self.add_time
+
+        def timed(*args):
+            start = default_timer()
+            result = func(*args)
+            add_time(stage, default_timer() - start)
+            if count is not None:
+                count(args, result)
+            return result
+        return timed
+
+    def instrument(self, module):
+        """ Swaps the timed wrappers into module (osm_pipeline). Returns the originals for restore(). """
+        originals = dict((name, getattr(module, name)) for name in ('shape_element', 'clean_tag', 'is_problem_key'))
+        keys, dropped_keys = self.keys, self.dropped_keys
+
+        def count_key(args, result):
+            keys[args[1].attrib['k']] += 1
+
+        def count_dropped(args, problem):
+            if problem:
+                dropped_keys[args[0]] += 1
+
+        module.shape_element = self._timed('shape_element', originals['shape_element'])
+        module.clean_tag = self._timed('clean_tag', originals['clean_tag'], count_key)
+        module.is_problem_key = self._timed('problem_chars', originals['is_problem_key'], count_dropped)
+        return originals
+
+    def restore(self, module, originals):
+        for name, func in originals.items():
+            setattr(module, name, func)
+
+    def open_input(self, file_in):
+        """ file_in, a path or a file-like object, wrapped to count the bytes parsed. """
+        if hasattr(file_in, 'read'):
+            return CountingFile(file_in, self)
+        return CountingFile(open(file_in, 'rb'), self)
+
+    def wrap_writers(self, writers):
+        return dict((key, TimedWriter(writer, self)) for key, writer in writers.items())
+
+    def iter_elements(self, elements):
+        """ Yields from elements, timing the parse and printing progress. """
+        elements = iter(elements)
+        counts = self.elements
+        last = start = default_timer()
+        n = 0
+        while True:
+            parse_start = default_timer()
+            try:
+                element = next(elements)
+            except StopIteration:
+                return
+            self.add_time('parse', default_timer() - parse_start)
+            counts[element.tag] += 1
+            n += 1
+            ## Looking at the clock only every 1024 elements keeps progress cheap
+            if self.progress_interval and not n & 1023:
+                now = default_timer()
+                if now - last >= self.progress_interval:
+                    self.progress(n, now - start)
+                    last = now
+            yield element
+
+    def progress(self, n, elapsed):
+        print('%10d elements  %9.0f el/s  %7.2f MB/s  rss %6.1f MB'
+              % (n, n / elapsed, self.input_bytes / 1048576.0 / elapsed, current_rss_mb() or 0),
+              file=self.stream)
+
+    def start(self):
+        self.started = default_timer()
+        if self.sampler is not None:
+            self.sampler.start()
+
+    def elapsed(self):
+        return default_timer() - self.started
+
+    def stop(self, output_paths=()):
+        if self.sampler is not None:
+            self.sampler.stop()
+        self.wall = default_timer() - self.started
+        self.output_bytes = sum(os.path.getsize(path) for path in output_paths if os.path.exists(path))
+        self.peak_rss = peak_rss_mb()
+
+    def merge(self, summary):
+        """ Adds the summary() of a worker's profile. """
+        for stage, stats in summary['stages'].items():
+            self.times[stage] += stats['seconds']
+            self.calls[stage] += stats['calls']
+        for counts, other in ((self.elements, summary['elements']), (self.keys, summary['keys']),
+                              (self.dropped_keys, summary['dropped_keys'])):
+            for name, n in other.items():
+                counts[name] += n
+        self.input_bytes += summary['input_bytes']
+        if summary['peak_rss_mb'] is not None:
+            self.worker_peak_rss = max(self.worker_peak_rss or 0, summary['peak_rss_mb'])
+        if self.sampler is not None:
+            for stack, n in summary.get('stacks', {}).items():
+                self.sampler.stacks[stack] += n
+
+    def summary(self):
+        """ Everything measured, as a dictionary ready for json. """
+        n_elements = sum(self.elements.values())
+        stages = {}
+        for stage in STAGES:
+            if stage not in self.calls:
+                continue
+            seconds = self.times[stage]
+            stats = {'seconds': seconds, 'calls': self.calls[stage],
+                     'calls_per_s': self.calls[stage] / seconds if seconds else None,
+                     'elements_per_s': n_elements / seconds if seconds else None}
+            if stage == 'parse':
+                stats['bytes_per_s'] = self.input_bytes / seconds if seconds else None
+            elif stage == 'write':
+                stats['bytes_per_s'] = self.output_bytes / seconds if seconds else None
+            stages[stage] = stats
+
+        summary = {
+            'wall_s': self.wall,
+            'workers': self.workers,
+            'elements': dict(self.elements),
+            'elements_per_s': n_elements / self.wall if self.wall else None,
+            'input_bytes': self.input_bytes,
+            'output_bytes': self.output_bytes,
+            'bytes_per_s': self.input_bytes / self.wall if self.wall else None,
+            'peak_rss_mb': self.peak_rss,
+            'worker_peak_rss_mb': self.worker_peak_rss,
+            'stages': stages,
+            'keys': dict(self.keys),
+            'dropped_keys': dict(self.dropped_keys),
+        }
+        if self.sampler is not None:
+            summary['stacks'] = dict(self.sampler.stacks)
+            summary['top_functions'] = self.sampler.top()
+        return summary
+
+    def write_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2, sort_keys=True)
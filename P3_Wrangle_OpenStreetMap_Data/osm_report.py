@@ -0,0 +1,59 @@
+# coding: utf-8
+
+"""
+Summary statistics of the OSM database for the cell 7 report.
+
+Every table is read once: one GROUP BY over (user, uid) per element table
+gives the node/way counts and the user statistics, and one GROUP BY over
+(key, value) per tag table gives the value histograms of all requested keys.
+Results are returned as dictionaries rather than printed.
+"""
+
+from collections import defaultdict
+
+ELEMENT_TABLES = ('nodes', 'ways')
+TAG_TABLES = ('nodes_tags', 'ways_tags')
+
+
+def user_summary(cur, tables=ELEMENT_TABLES, top=10):
+    """
+    Returns the number of rows per table, the number of unique uids over all
+    tables and the top contributing users as (user, count) pairs.
+    """
+    counts = {}
+    per_user = defaultdict(int)
+    uids = set()
+    for table in tables:
+        total = 0
+        for user, uid, n in cur.execute('SELECT user, uid, COUNT(*) FROM %s GROUP BY user, uid' % table):
+            total += n
+            per_user[user] += n
+            uids.add(uid)
+        counts[table] = total
+
+    top_users = sorted(per_user.items(), key=lambda item: (-item[1], item[0]))[:top]
+    return {'counts': counts, 'unique_users': len(uids), 'top_users': top_users}
+
+
+def tag_summary(cur, keys, tables=TAG_TABLES):
+    """
+    Returns {key: {table: {'values': {value: count}, 'total': count}}} for every
+    key, with a single grouped query per table.
+    """
+    keys = list(keys)
+    summary = dict((key, dict((table, {'values': {}, 'total': 0}) for table in tables)) for key in keys)
+    placeholders = ','.join('?' * len(keys))
+    for table in tables:
+        sql = 'SELECT key, value, COUNT(*) FROM %s WHERE key IN (%s) GROUP BY key, value' % (table, placeholders)
+        for key, value, n in cur.execute(sql, keys):
+            entry = summary[key][table]
+            entry['values'][value] = n
+            entry['total'] += n
+    return summary
+
+
+def summarize(cur, keys, top=10):
+    """ Everything the cell 7 report needs, one scan per table. """
+    report = user_summary(cur, top=top)
+    report['tags'] = tag_summary(cur, keys)
+    return report
@@ -0,0 +1,85 @@
+# coding: utf-8
+
+"""
+Table driven cleaning rules for tag values.
+
+The rules live in cleaning_rules.json:
+
+    "values":   {key: {old value: new value}}  exact replacements
+    "patterns": [{"key", "pattern", "replace", "ignore_case"}]  regex rewrites
+
+They are compiled once into a dictionary per key and a list of precompiled
+patterns per key, so cleaning a tag costs one dictionary lookup on its key
+however many rules there are. Every rule counts how often it fired.
+"""
+
+import json
+import os
+import re
+from collections import defaultdict
+
+RULES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cleaning_rules.json')
+
+
+class CleaningRules(object):
+
+    def __init__(self, values=None, patterns=()):
+        ## key -> (exact replacements, [(compiled pattern, replacement, rule name)])
+        self.rules = {}
+        self.hits = defaultdict(int)
+
+        for key, mapping in (values or {}).items():
+            self._rules_for(key)[0].update(mapping)
+
+        for rule in patterns:
+            flags = re.IGNORECASE if rule.get('ignore_case') else 0
+            name = '%s: /%s/ -> %s' % (rule['key'], rule['pattern'], rule['replace'])
+            self._rules_for(rule['key'])[1].append((re.compile(rule['pattern'], flags), rule['replace'], name))
+
+    def _rules_for(self, key):
+        if key not in self.rules:
+            self.rules[key] = ({}, [])
+        return self.rules[key]
+
+    @classmethod
+    def load(cls, path=RULES_PATH):
+        with open(path) as f:
+            spec = json.load(f)
+        return cls(spec.get('values'), spec.get('patterns', ()))
+
+    def clean(self, key, value):
+        """
+        Returns the cleaned value of a tag. Exact replacements win over patterns
+        and the first pattern that changes the value is the only one applied.
+        """
+        rules = self.rules.get(key)
+        if rules is None:
+            return value
+
+        mapping, patterns = rules
+        if value in mapping:
+            self.hits['%s: %s -> %s' % (key, value, mapping[value])] += 1
+            return mapping[value]
+
+        for pattern, replace, name in patterns:
+            new_value = pattern.sub(replace, value)
+            if new_value != value:
+                self.hits[name] += 1
+                return new_value
+        return value
+
+    def reset(self):
+        self.hits.clear()
+
+    def merge(self, hits):
+        """ Adds hit counts collected elsewhere, e.g. in a worker process. """
+        for name, n in hits.items():
+            self.hits[name] += n
+
+    def report(self):
+        """ (rule, hits) pairs of the rules that fired, most used first. """
+        return sorted(self.hits.items(), key=lambda item: (-item[1], item[0]))
+
+
+## Rules used by clean_tag unless it is given others
+CLEANING_RULES = CleaningRules.load()
@@ -0,0 +1,121 @@
+# coding: utf-8
+
+"""
+Spatial index and location queries over the nodes table of mydv.db.
+
+The index is an SQLite R*Tree, nodes_rtree, holding every node as a point box.
+load_map() builds it after the bulk insert and triggers on nodes keep it in
+step with later inserts and deletes, e.g. from apply_changes(). Queries only
+visit the tree pages around the searched area instead of scanning nodes:
+
+    nodes_in_bbox(cur, min_lat, min_lon, max_lat, max_lon)
+    nodes_within(cur, lat, lon, radius_m)
+    nearest_nodes(cur, lat, lon, k)
+
+All of them take an optional tag key and value, matched through nodes_tags,
+e.g. nearest_nodes(cur, -37.81, 144.96, 5, key='amenity', value='cafe').
+"""
+
+import math
+
+## R*Tree boxes are stored as 32 bit floats, so they are only used to find
+## candidates and the exact coordinates in nodes decide
+SPATIAL_SCHEMA = [
+    'CREATE VIRTUAL TABLE nodes_rtree USING rtree(id, min_lat, max_lat, min_lon, max_lon)',
+    '''CREATE TRIGGER nodes_rtree_insert AFTER INSERT ON nodes BEGIN
+        INSERT INTO nodes_rtree VALUES (new.id, new.lat, new.lat, new.lon, new.lon);
+    END''',
+    '''CREATE TRIGGER nodes_rtree_delete AFTER DELETE ON nodes BEGIN
+        DELETE FROM nodes_rtree WHERE id = old.id;
+    END''',
+]
+
+EARTH_RADIUS_M = 6371008.8
+METERS_PER_DEGREE = math.pi * EARTH_RADIUS_M / 180
+
+## nearest_nodes starts from this radius and doubles it until it holds k nodes
+START_RADIUS_M = 100.0
+MAX_RADIUS_M = math.pi * EARTH_RADIUS_M
+
+
+def create_spatial_index(cur):
+    """ (Re)builds nodes_rtree from the nodes table and installs the triggers keeping it current. """
+    cur.execute('DROP TABLE IF EXISTS nodes_rtree')
+    for create in SPATIAL_SCHEMA:
+        cur.execute(create)
+    cur.execute('INSERT INTO nodes_rtree SELECT id, lat, lat, lon, lon FROM nodes')
+
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    """ Great circle distance in metres between two points given in degrees. """
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2 +
+         math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(a)))
+
+
+def radius_bbox(lat, lon, radius_m):
+    """ (min_lat, min_lon, max_lat, max_lon) of a box containing the circle around (lat, lon). """
+    d_lat = radius_m / METERS_PER_DEGREE
+    cos_lat = math.cos(math.radians(min(89.9, abs(lat) + d_lat)))
+    d_lon = min(180.0, d_lat / cos_lat)
+    return lat - d_lat, lon - d_lon, lat + d_lat, lon + d_lon
+
+
+def _bbox_query(key, value):
+    """
+    SQL selecting (id, lat, lon, tag value) of the nodes in a box, optionally
+    with a tag. CROSS JOIN makes SQLite start from the tree, left to itself it
+    reads every node with the tag through the nodes_tags (key, value) index.
+    """
+    sql = 'SELECT n.id, n.lat, n.lon, %s FROM nodes_rtree r CROSS JOIN nodes n ON n.id = r.id '
+    params = []
+    if key is None:
+        sql %= 'NULL'
+    else:
+        sql %= 't.value'
+        sql += 'CROSS JOIN nodes_tags t ON t.id = n.id AND t.key = ? '
+        params.append(key)
+        if value is not None:
+            sql += 'AND t.value = ? '
+            params.append(value)
+    ## Overlap test on the tree, it never misses a point whose box was rounded outwards
+    sql += ('WHERE r.max_lat >= ? AND r.min_lat <= ? AND r.max_lon >= ? AND r.min_lon <= ? '
+            'AND n.lat BETWEEN ? AND ? AND n.lon BETWEEN ? AND ?')
+    return sql, params
+
+
+def nodes_in_bbox(cur, min_lat, min_lon, max_lat, max_lon, key=None, value=None):
+    """
+    Returns (id, lat, lon, value) of the nodes inside the box. With a key only
+    nodes carrying that tag are returned, with its value, else value is None.
+    """
+    sql, params = _bbox_query(key, value)
+    box = [min_lat, max_lat, min_lon, max_lon]
+    return cur.execute(sql, params + box + box).fetchall()
+
+
+def nodes_within(cur, lat, lon, radius_m, key=None, value=None):
+    """ Returns (distance in metres, id, lat, lon, value) of the nodes within radius_m, nearest first. """
+    found = []
+    for node_id, n_lat, n_lon, tag_value in nodes_in_bbox(cur, *radius_bbox(lat, lon, radius_m),
+                                                          key=key, value=value):
+        distance = haversine_m(lat, lon, n_lat, n_lon)
+        if distance <= radius_m:
+            found.append((distance, node_id, n_lat, n_lon, tag_value))
+    found.sort()
+    return found
+
+
+def nearest_nodes(cur, lat, lon, k=1, key=None, value=None):
+    """
+    Returns the k nodes nearest to (lat, lon) as in nodes_within. The search
+    circle doubles until it holds k nodes, so only the tree around the point is
+    read. Fewer than k are returned if the table has fewer matching nodes.
+    """
+    radius_m = START_RADIUS_M
+    while True:
+        found = nodes_within(cur, lat, lon, radius_m, key=key, value=value)
+        if len(found) >= k or radius_m >= MAX_RADIUS_M:
+            return found[:k]
+        radius_m *= 2
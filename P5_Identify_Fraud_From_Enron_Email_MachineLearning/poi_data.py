@@ -0,0 +1,124 @@
+# coding: utf-8
+
+"""
+Columnar Enron dataset with vectorized features.
+
+from_dict() turns the dict of dicts of final_project_dataset.pkl into a
+DataFrame indexed by person, one float64 column per financial and email
+feature with real NaNs instead of 'NaN' strings, poi as bool. Derived features
+are registered with @derived_feature as expressions over whole columns and
+add_features() computes them all in one pass. NaN in any input gives NaN.
+
+feature_matrix() replaces featureFormat for the frame and to_dict() gives the
+dict of dicts back for tester.py.
+"""
+
+from __future__ import division
+
+import pickle
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+# string used for missing values in the dict of dicts
+NAN = 'NaN'
+
+# features that are not numbers
+TEXT_FEATURES = ['email_address']
+
+# name -> function of the frame returning the feature as a column, in order of registration
+DERIVED_FEATURES = OrderedDict()
+
+
+def from_dict(dataset):
+    """
+    DataFrame of the dict of dicts dataset with a column for every feature any
+    person has, in the order they are first seen. Features a person lacks are
+    missing values, a missing poi is False.
+    """
+    names = sorted(dataset)
+    features = OrderedDict()
+    for person in dataset.values():
+        features.update((feature, None) for feature in person)
+    columns = OrderedDict()
+    for feature in features:
+        values = [dataset[name].get(feature, NAN) for name in names]
+        if feature == 'poi':
+            columns[feature] = np.array([v != NAN and bool(v) for v in values], dtype=bool)
+        elif feature in TEXT_FEATURES:
+            columns[feature] = np.array([None if v == NAN else v for v in values], dtype=object)
+        else:
+            columns[feature] = np.array([np.nan if v == NAN else v for v in values], dtype=np.float64)
+    return pd.DataFrame(columns, index=pd.Index(names, name='name'))
+
+
+def load_dataset(path):
+    with open(path, 'rb') as data_file:
+        return from_dict(pickle.load(data_file))
+
+
+def to_dict(frame):
+    """ The dict of dicts featureFormat and tester.py expect, with 'NaN' for missing values. """
+    dataset = {}
+    for name, row in zip(frame.index, frame.to_dict('records')):
+        dataset[name] = dict((feature, NAN if value is None or value != value else value)
+                             for feature, value in row.items())
+    return dataset
+
+
+def derived_feature(name):
+    """ Registers the decorated function of the frame as the derived feature name. """
+    def register(func):
+        DERIVED_FEATURES[name] = func
+        return func
+    return register
+
+
+@derived_feature('interaction_with_poi')
+def interaction_with_poi(d):
+    # ratio of person's correspondence with poi to their total correspondence
+    return (d['from_poi_to_this_person'] + d['from_this_person_to_poi']) / (d['to_messages'] + d['from_messages'])
+
+
+@derived_feature('payments_ratio')
+def payments_ratio(d):
+    # ratio of deferral payments to total payments
+    return d['deferral_payments'] / d['total_payments']
+
+
+@derived_feature('salary_payments_ratio')
+def salary_payments_ratio(d):
+    # ratio of income to total payments, the bonus is added to the ratio as the original loop did
+    return d['total_payments'] / d['salary'] + d['bonus']
+
+
+def add_features(frame, names=None):
+    """
+    Copy of frame with the derived features in names, all registered ones by
+    default, added as columns. Each one may use the ones registered before it.
+    Divisions by zero give NaN rather than inf.
+    """
+    frame = frame.copy()
+    for name in (list(DERIVED_FEATURES) if names is None else names):
+        frame[name] = DERIVED_FEATURES[name](frame).replace([np.inf, -np.inf], np.nan)
+    return frame
+
+
+def feature_matrix(frame, features, remove_all_zeroes=True, sort_keys=True):
+    """
+    Same array as featureFormat(dataset, features, sort_keys=sort_keys): NaN
+    becomes 0, and rows whose features other than poi are all 0 are dropped.
+    """
+    data = frame[features].astype(np.float64).fillna(0.0)
+    if sort_keys:
+        data = data.sort_index()
+    if remove_all_zeroes:
+        rest = data[features[1:]] if features[0] == 'poi' else data
+        data = data[(rest != 0).any(axis=1)]
+    return data.to_numpy()
+
+
+def split_target(data):
+    """ targetFeatureSplit for the array of feature_matrix: labels and features. """
+    return data[:, 0], data[:, 1:]
@@ -0,0 +1,312 @@
+# coding: utf-8
+
+"""
+Email features of the dataset recomputed from a mail corpus.
+
+    counts = email_features('maildir', frame, checkpoint='email_checkpoint.jsonl')
+    frame = add_features(with_email_features(frame, counts))
+
+The corpus is a directory tree with one message per file, as the Enron
+maildir is, and/or mbox files. Only the headers of every message are read:
+From, To, Cc and Bcc are matched against the email_address of each person of
+the frame, and per person
+
+    to_messages               messages they received
+    from_messages             messages they sent
+    from_poi_to_this_person   messages they received from a poi
+    from_this_person_to_poi   messages they sent to at least one poi
+    shared_receipt_with_poi   messages they received together with a poi
+
+are counted. A message is counted once per file it is found in, as the
+folders of a mailbox hold it.
+
+Files are parsed in chunks, in this process by default, or with workers > 1
+(None for one per core) on a process pool whose workers get the address book
+once when they start. Pool processes may import the main module again, so
+only ask for them from under an if __name__ == '__main__': guard.
+
+With a checkpoint the counts of every finished chunk are appended to it, and
+a later run with the same address book skips the files already counted, so
+an interrupted job picks up where it stopped.
+"""
+
+from __future__ import division, print_function
+
+import hashlib
+import json
+import os
+import sys
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from email.parser import BytesHeaderParser
+from email.utils import getaddresses
+
+import numpy as np
+import pandas as pd
+
+# the email features of final_project_dataset.pkl
+EMAIL_FEATURES = ['to_messages', 'from_messages', 'from_poi_to_this_person', 'from_this_person_to_poi',
+                  'shared_receipt_with_poi']
+
+RECIPIENT_HEADERS = ('to', 'cc', 'bcc')
+
+# files parsed per task, an mbox file is always one task
+CHUNK_FILES = 500
+
+# a read stops at the end of the headers, they rarely take more than this
+HEADER_BLOCK = 16384
+
+CHECKPOINT_VERSION = 1
+
+MBOX_SUFFIX = '.mbox'
+
+
+def address_book(frame):
+    """ Lower case email address -> (person, is poi) of every person of frame with an address. """
+    book = {}
+    for name, address, poi in zip(frame.index, frame['email_address'], frame['poi']):
+        if address is not None and address == address:
+            book[address.strip().lower()] = (name, bool(poi))
+    return book
+
+
+def book_digest(book):
+    """ Digest of an address book: a checkpoint is only valid for the book it was counted with. """
+    return hashlib.sha256(json.dumps(sorted(book.items())).encode('utf-8')).hexdigest()
+
+
+def read_headers(path):
+    """ Header block of the message file at path, without reading its body. """
+    with open(path, 'rb') as f:
+        data = b''
+        while True:
+            block = f.read(HEADER_BLOCK)
+            data += block
+            for end in (b'\r\n\r\n', b'\n\n'):
+                index = data.find(end)
+                if index >= 0:
+                    return data[:index + len(end)]
+            if not block:
+                return data
+
+
+def mbox_headers(path):
+    """ Header blocks of the messages of the mbox file at path, skipping the bodies line by line. """
+    headers, in_headers = [], False
+    with open(path, 'rb') as f:
+        for line in f:
+            if line.startswith(b'From '):
+                headers, in_headers = [], True
+            elif in_headers:
+                if line.strip():
+                    headers.append(line)
+                else:
+                    in_headers = False
+                    yield b''.join(headers)
+    if in_headers:
+        yield b''.join(headers)
+
+
+def addresses(values):
+    """
+    Lower case addresses of header values. Lists of bare addresses, all the
+    Enron headers hold, are split on commas; getaddresses, which takes most of
+    the time of a run, is only used for values with display names or comments.
+    """
+    found = []
+    for value in values:
+        value = str(value)
+        if '<' in value or '"' in value or '(' in value:
+            found.extend(address for _, address in getaddresses([value]))
+        else:
+            found.extend(value.split(','))
+    return [address.strip().lower() for address in found if address.strip()]
+
+
+def parse_addresses(header_block, parser=BytesHeaderParser()):
+    """ (sender, set of recipients) of a header block, lower case addresses. """
+    message = parser.parsebytes(header_block)
+    sender = addresses(message.get_all('from', []))
+    recipients = addresses(value for name in RECIPIENT_HEADERS for value in message.get_all(name, []))
+    return sender[0] if sender else None, set(recipients)
+
+
+def count_message(counts, book, sender, recipients):
+    """ Adds one message to counts, a Counter of (person, feature). """
+    known_sender = book.get(sender)
+    poi_recipients = set(a for a in recipients if a in book and book[a][1])
+    if known_sender is not None:
+        counts[known_sender[0], 'from_messages'] += 1
+        if poi_recipients - set([sender]):
+            counts[known_sender[0], 'from_this_person_to_poi'] += 1
+    for address in recipients:
+        person = book.get(address)
+        if person is None:
+            continue
+        counts[person[0], 'to_messages'] += 1
+        if known_sender is not None and known_sender[1] and sender != address:
+            counts[person[0], 'from_poi_to_this_person'] += 1
+        if poi_recipients - set([address]):
+            counts[person[0], 'shared_receipt_with_poi'] += 1
+
+
+def count_files(paths, book):
+    """ Counter of (person, feature) over the messages of paths, message files or mbox files. """
+    counts = Counter()
+    for path in paths:
+        if path.endswith(MBOX_SUFFIX):
+            blocks = mbox_headers(path)
+        else:
+            blocks = [read_headers(path)]
+        for block in blocks:
+            sender, recipients = parse_addresses(block)
+            count_message(counts, book, sender, recipients)
+    return counts
+
+
+def corpus_files(corpus):
+    """ Relative paths of every file under corpus, sorted, or the file corpus itself. """
+    if os.path.isfile(corpus):
+        return [os.path.basename(corpus)]
+    files = []
+    for directory, subdirectories, names in os.walk(corpus):
+        subdirectories.sort()
+        files.extend(os.path.relpath(os.path.join(directory, name), corpus) for name in sorted(names))
+    return files
+
+
+def chunk_files(files):
+    """ Tasks of CHUNK_FILES message files, each mbox file a task of its own. """
+    chunks, messages = [], []
+    for path in files:
+        if path.endswith(MBOX_SUFFIX):
+            chunks.append([path])
+        else:
+            messages.append(path)
+    chunks.extend(messages[start:start + CHUNK_FILES] for start in range(0, len(messages), CHUNK_FILES))
+    return chunks
+
+
+# address book and corpus root of the pool's worker processes, set once by _init_worker
+_shared = {}
+
+
+def _init_worker(book, root):
+    _shared.update(book=book, root=root)
+
+
+def _count_chunk(files):
+    counts = count_files([os.path.join(_shared['root'], path) for path in files], _shared['book'])
+    return files, counts
+
+
+def read_checkpoint(path, digest):
+    """
+    (files done, Counter of (person, feature)) stored in the checkpoint at
+    path, nothing if it was counted with another address book. A last line
+    cut short by an interrupted write is ignored.
+    """
+    done, counts = set(), Counter()
+    if path is None or not os.path.exists(path):
+        return done, counts
+    with open(path) as f:
+        lines = f.read().split('\n')
+    try:
+        header = json.loads(lines[0])
+    except ValueError:
+        return done, counts
+    if header.get('version') != CHECKPOINT_VERSION or header.get('book') != digest:
+        return done, counts
+    for line in lines[1:]:
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            continue
+        done.update(entry['files'])
+        for person, features in entry['counts'].items():
+            for feature, n in features.items():
+                counts[person, feature] += n
+    return done, counts
+
+
+def _last_byte(path):
+    with open(path, 'rb') as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1)
+
+
+def _checkpoint_entry(files, counts):
+    per_person = defaultdict(dict)
+    for (person, feature), n in counts.items():
+        per_person[person][feature] = n
+    return json.dumps({'files': files, 'counts': per_person}, sort_keys=True)
+
+
+def email_features(corpus, frame, checkpoint=None, workers=1):
+    """
+    DataFrame of EMAIL_FEATURES per person of frame counted over the corpus
+    directory or mbox file, NaN for people without an email address. With a
+    checkpoint path the files counted by an earlier run with the same address
+    book are skipped. workers > 1, or None for one per core, counts on a pool.
+    """
+    book = address_book(frame)
+    digest = book_digest(book)
+    done, counts = read_checkpoint(checkpoint, digest)
+    root = corpus if os.path.isdir(corpus) else os.path.dirname(corpus)
+    chunks = chunk_files([path for path in corpus_files(corpus) if path not in done])
+
+    log = None
+    if checkpoint is not None and not done:
+        log = open(checkpoint, 'w')
+        log.write(json.dumps({'version': CHECKPOINT_VERSION, 'book': digest}) + '\n')
+        log.flush()
+    elif checkpoint is not None:
+        log = open(checkpoint, 'a')
+        # ends a line cut short by an interrupted run, read_checkpoint skips it
+        if log.tell() and _last_byte(checkpoint) != b'\n':
+            log.write('\n')
+    try:
+        if workers == 1:
+            _init_worker(book, root)
+            results = map(_count_chunk, chunks)
+        else:
+            pool = ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(book, root))
+            results = pool.map(_count_chunk, chunks)
+        try:
+            for files, chunk_counts in results:
+                counts.update(chunk_counts)
+                if log is not None:
+                    log.write(_checkpoint_entry(files, chunk_counts) + '\n')
+                    log.flush()
+        finally:
+            if workers != 1:
+                pool.shutdown()
+    finally:
+        if log is not None:
+            log.close()
+
+    table = pd.DataFrame(np.nan, index=frame.index, columns=EMAIL_FEATURES)
+    known = sorted(set(name for name, _ in book.values()))
+    table.loc[known] = 0.0
+    for (person, feature), n in counts.items():
+        table.loc[person, feature] = n
+    return table
+
+
+def with_email_features(frame, counts):
+    """ Copy of frame with its email features replaced by those of email_features(). """
+    frame = frame.copy()
+    for feature in EMAIL_FEATURES:
+        frame[feature] = counts[feature]
+    return frame
+
+
+if __name__ == '__main__':
+    from poi_data import load_dataset
+    if len(sys.argv) < 2:
+        sys.exit('usage: python poi_email.py corpus [checkpoint]')
+    pd.set_option('display.width', 120)
+    frame = load_dataset('my_dataset.pkl')
+    # guarded, so the counting can use every core
+    counts = email_features(sys.argv[1], frame, sys.argv[2] if len(sys.argv) > 2 else None, workers=None)
+    print(counts.to_string())
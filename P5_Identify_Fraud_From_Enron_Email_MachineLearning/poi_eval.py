@@ -0,0 +1,271 @@
+# coding: utf-8
+
+"""
+Cached, optionally parallel comparison of classifiers on the tester.py metrics.
+
+compare() builds the feature matrix and the stratified shuffle splits once
+and evaluates each candidate on chunks of the splits. Precision, recall, F1
+and F2 are computed from the confusion counts summed over all splits, the same
+way tester.py does it, and fit/predict times are measured per split. The
+counts of a chunk come from one bincount over all of its predictions, and the
+splits are kept per digest of the labels, folds and seed for later
+evaluations.
+
+Everything runs in this process by default. With workers > 1, or None for a
+process per core, the chunks are evaluated on a pool whose processes get the
+data once when they start. Pool processes may import the main module again
+(the spawn and forkserver start methods do), so only ask for them from code
+under an if __name__ == '__main__': guard.
+
+test_classifier() prints tester.py's report from these numbers.
+
+Results are cached on disk, one json file per candidate, keyed by the
+classifier's class and parameters, the feature list, the splits, a digest of
+the data and the versions of Python, scikit-learn, NumPy and pandas, so a
+candidate is only evaluated again when one of them changes.
+"""
+
+from __future__ import division, print_function
+
+import hashlib
+import json
+import os
+import sys
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import sklearn
+from sklearn import config_context
+from sklearn.base import clone
+from sklearn.model_selection import StratifiedShuffleSplit
+
+from poi_data import feature_matrix, split_target
+
+# the settings of tester.py
+FOLDS = 1000
+RANDOM_STATE = 42
+TEST_SIZE = 0.1
+
+# splits evaluated per task, small enough to spread a slow candidate over all workers
+CHUNK_FOLDS = 100
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.poi_cache')
+
+# part of every cache key, results of other library versions may differ
+VERSIONS = (sys.version_info[:2], sklearn.__version__, np.__version__, pd.__version__)
+
+# in the order of confusion_counts' bincount, 2 * predicted + truth
+COUNTS = ['true_negatives', 'false_negatives', 'false_positives', 'true_positives']
+COLUMNS = ['accuracy', 'precision', 'recall', 'f1', 'f2', 'fit_ms', 'predict_ms', 'cached']
+
+# the report of tester.py
+PERF_FORMAT_STRING = "\tAccuracy: {:>0.{display_precision}f}\tPrecision: {:>0.{display_precision}f}\t" \
+                     "Recall: {:>0.{display_precision}f}\tF1: {:>0.{display_precision}f}\tF2: {:>0.{display_precision}f}"
+RESULTS_FORMAT_STRING = "\tTotal predictions: {:4d}\tTrue positives: {:4d}\tFalse positives: {:4d}\t" \
+                        "False negatives: {:4d}\tTrue negatives: {:4d}"
+
+
+# (digest of the labels, folds, random_state) -> splits, the labels are all the splits depend on
+_splits = {}
+
+
+def make_splits(labels, folds=FOLDS, random_state=RANDOM_STATE, test_size=TEST_SIZE):
+    """ (train indices, test indices) of every stratified shuffle split, as tester.py draws them. """
+    key = (hashlib.sha256(np.ascontiguousarray(labels).tobytes()).hexdigest(), folds, random_state, test_size)
+    if key not in _splits:
+        cv = StratifiedShuffleSplit(n_splits=folds, test_size=test_size, random_state=random_state)
+        _splits[key] = list(cv.split(np.zeros(len(labels)), labels))
+    return _splits[key]
+
+
+def scores(counts):
+    """ tester.py's metrics from the summed confusion counts, NaN where they are undefined. """
+    tn, fn, fp, tp = [counts[name] for name in COUNTS]
+    total = tn + fn + fp + tp
+    precision = tp / (tp + fp) if tp + fp else np.nan
+    recall = tp / (tp + fn) if tp + fn else np.nan
+    f1 = 2 * tp / (2 * tp + fp + fn) if tp else np.nan
+    f2 = (1 + 2 ** 2) * precision * recall / (4 * precision + recall) if tp else np.nan
+    return {'accuracy': (tp + tn) / total, 'precision': precision, 'recall': recall, 'f1': f1, 'f2': f2}
+
+
+def confusion_counts(truth, predicted):
+    """ tester.py's confusion counts of 0/1 label arrays, in one bincount over all predictions. """
+    counts = np.bincount(2 * (np.asarray(predicted) == 1) + (np.asarray(truth) == 1), minlength=4)
+    return dict((name, int(count)) for name, count in zip(COUNTS, counts))
+
+
+def evaluate_splits(clf, features, labels, splits, columns=None):
+    """
+    Fits a clone of clf on every split, refitting the same clone as tester.py
+    refits clf. columns, if given, holds the column indices of features used
+    on each split. Returns the summed confusion counts and times. The matrix
+    has no NaN, so scikit-learn's finiteness and parameter checks are skipped.
+    """
+    fit_s = predict_s = 0.0
+    predictions = []
+    model = clone(clf)
+    with config_context(assume_finite=True, skip_parameter_validation=True):
+        for i, (train, test) in enumerate(splits):
+            data = features if columns is None else features[:, columns[i]]
+            start = time.perf_counter()
+            model.fit(data[train], labels[train])
+            fitted = time.perf_counter()
+            predictions.append(model.predict(data[test]))
+            fit_s += fitted - start
+            predict_s += time.perf_counter() - fitted
+
+    result = confusion_counts(labels[np.concatenate([test for _, test in splits])], np.concatenate(predictions))
+    result.update(fit_s=fit_s, predict_s=predict_s)
+    return result
+
+
+# data of the pool's worker processes, set once by _init_worker
+_shared = {}
+
+
+def _init_worker(features, labels, splits):
+    from sklearn.exceptions import ConvergenceWarning
+    warnings.simplefilter('ignore', ConvergenceWarning)
+    _shared.update(features=features, labels=labels, splits=splits)
+
+
+def _evaluate_chunk(task):
+    name, clf, start, stop, columns = task
+    return name, evaluate_splits(clf, _shared['features'], _shared['labels'], _shared['splits'][start:stop], columns)
+
+
+def chunk_tasks(name, clf, folds, columns=None):
+    """
+    Tasks for run_tasks() evaluating clf on all folds in chunks of CHUNK_FOLDS.
+    columns are the column indices used on each fold, all columns when None.
+    """
+    return [(name, clf, start, min(start + CHUNK_FOLDS, folds),
+             None if columns is None else columns[start:start + CHUNK_FOLDS])
+            for start in range(0, folds, CHUNK_FOLDS)]
+
+
+def run_tasks(tasks, features, labels, splits, workers=1):
+    """
+    Runs the tasks of chunk_tasks() in this process, or with workers > 1 (None
+    for a process per core) on a pool whose processes get features, labels and
+    splits once when they start.
+    Returns the confusion counts and times summed per name.
+    """
+    totals = {}
+    if workers == 1:
+        _init_worker(features, labels, splits)
+        chunks = map(_evaluate_chunk, tasks)
+    else:
+        pool = ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(features, labels, splits))
+        chunks = pool.map(_evaluate_chunk, tasks)
+    try:
+        for name, chunk in chunks:
+            total = totals.setdefault(name, dict.fromkeys(chunk, 0))
+            for field, value in chunk.items():
+                total[field] += value
+    finally:
+        if workers != 1:
+            pool.shutdown()
+    return totals
+
+
+def summarize(total, folds):
+    """ Confusion counts, tester.py's metrics and mean fit and predict milliseconds of a run_tasks() total. """
+    result = dict((field, total[field]) for field in COUNTS)
+    result.update(scores(total))
+    result['fit_ms'] = total['fit_s'] / folds * 1000
+    result['predict_ms'] = total['predict_s'] / folds * 1000
+    return result
+
+
+def cache_key(clf, feature_list, features, labels, folds, random_state):
+    """ Digest of everything a result depends on. """
+    params = sorted((key, repr(value)) for key, value in clf.get_params(deep=True).items())
+    digest = hashlib.sha256()
+    digest.update(repr((type(clf).__module__, type(clf).__name__, params, list(feature_list),
+                        folds, random_state, TEST_SIZE, VERSIONS)).encode('utf-8'))
+    digest.update(np.ascontiguousarray(features).tobytes())
+    digest.update(np.ascontiguousarray(labels).tobytes())
+    return digest.hexdigest()
+
+
+def _read_cache(cache_dir, key):
+    if cache_dir is None:
+        return None
+    path = os.path.join(cache_dir, key + '.json')
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_cache(cache_dir, key, result):
+    if cache_dir is None:
+        return
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    # written under a temporary name first so a reader never sees half a file
+    path = os.path.join(cache_dir, key + '.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(result, f)
+    os.replace(path + '.tmp', path)
+
+
+def compare(candidates, frame, feature_list, folds=FOLDS, random_state=RANDOM_STATE, workers=1,
+            cache_dir=CACHE_DIR):
+    """
+    Evaluates every (name, classifier) of candidates on feature_list of frame
+    and returns one table, a row per candidate in the order given, of
+    accuracy, precision, recall, F1, F2, mean fit and predict milliseconds per
+    split and whether the row came from the cache. cache_dir=None turns the
+    cache off, workers is passed on to run_tasks().
+    """
+    labels, features = split_target(feature_matrix(frame, feature_list))
+    keys = dict((name, cache_key(clf, feature_list, features, labels, folds, random_state))
+                for name, clf in candidates)
+    results = {}
+    for name, _ in candidates:
+        cached = _read_cache(cache_dir, keys[name])
+        if cached is not None:
+            results[name] = dict(cached, cached=True)
+
+    todo = [(name, clf) for name, clf in candidates if name not in results]
+    if todo:
+        splits = make_splits(labels, folds, random_state)
+        tasks = [task for name, clf in todo for task in chunk_tasks(name, clf, folds)]
+        totals = run_tasks(tasks, features, labels, splits, workers)
+        for name, _ in todo:
+            result = summarize(totals[name], folds)
+            _write_cache(cache_dir, keys[name], result)
+            results[name] = dict(result, cached=False)
+
+    table = pd.DataFrame([results[name] for name, _ in candidates], index=[name for name, _ in candidates])
+    return table[COLUMNS + COUNTS]
+
+
+def test_classifier(clf, frame, feature_list, folds=FOLDS, random_state=RANDOM_STATE, workers=1,
+                    cache_dir=CACHE_DIR):
+    """
+    tester.test_classifier for the frame of poi_data: prints the same report
+    from the same counts, computed by compare(). Returns the row of compare().
+    Unlike tester.py it fits copies, clf itself is left unfitted.
+    """
+    result = compare([(type(clf).__name__, clf)], frame, feature_list, folds, random_state, workers,
+                     cache_dir).iloc[0]
+    counts = [int(result[name]) for name in COUNTS]
+    print(clf)
+    # without a true positive tester.py divides by zero computing F2
+    if np.isnan(result['f2']):
+        print("Got a divide by zero when trying out:", clf)
+        print("Precision or recall may be undefined due to a lack of true positive predicitons.")
+    else:
+        print(PERF_FORMAT_STRING.format(result['accuracy'], result['precision'], result['recall'], result['f1'],
+                                        result['f2'], display_precision=5))
+        tn, fn, fp, tp = counts
+        print(RESULTS_FORMAT_STRING.format(sum(counts), tp, fp, fn, tn))
+        print("")
+    return result
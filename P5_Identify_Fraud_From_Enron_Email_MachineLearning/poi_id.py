@@ -1,17 +1,16 @@
 # coding: utf-8
 
 from __future__ import print_function
+import os
 import sys
 print(sys.version)
 sys.path.append("../tools")
 
-import random 
-
 from sklearn.feature_selection import SelectKBest
 from sklearn import preprocessing
+from sklearn.base import clone
 from sklearn.model_selection import train_test_split
-from sklearn.metrics import accuracy_score, precision_score, recall_score, classification_report
-from sklearn.model_selection import GridSearchCV
+from sklearn.metrics import classification_report
 
 from sklearn.linear_model import LogisticRegression
 from sklearn.naive_bayes import GaussianNB
@@ -19,169 +18,218 @@ from sklearn.ensemble import RandomForestClassifier, GradientBoostingClassifier,
 from sklearn.neural_network import MLPClassifier
 from sklearn.neighbors import KNeighborsClassifier
 
-from feature_format import featureFormat, targetFeatureSplit
-from tester import dump_classifier_and_data, test_classifier
+from tester import dump_classifier_and_data
+from poi_data import from_dict, to_dict, add_features, feature_matrix, split_target
+from poi_email import email_features, with_email_features
+from poi_eval import compare, test_classifier
+from poi_select import SubsetSearch
+from poi_stages import StageGraph
+from poi_tune import SCORERS, grid_search, best_params, grid_scores, refit, anova_pipeline
 
 import pickle
-import numpy as np
-import matplotlib.pyplot as plt
+import pandas as pd
+
+# every step is a stage whose output is cached in .poi_stages under a digest of its code, inputs
+# and the seed, so a rerun only repeats the stages something changed for; timings go to stderr
+graph = StageGraph(seed=42)
 
-with open("final_project_dataset.pkl", "rb") as data_file:
-    dataset = pickle.load(data_file)
+# processes the evaluations run on, None for one per core. Pool processes may import this script
+# again, which is safe as the graph only runs under the __main__ guard at the bottom
+WORKERS = 1
 
 # ### Task 1: Select what features you'll use.
 ### features_list is a list of strings, each of which is a feature name.
 ### The first feature must be "poi".
 features_list = ['poi','salary'] # You will need to use more features
 
-# brief check for outliers
-salaries, pois = [], []
-for k, v in dataset.items():
-    salaries.append(v['salary'])
-    pois.append(v['poi'] * 10000000)  # multiply for visual scale
 
-# plt.figure(figsize=(30,5))
-# plt.plot(salaries)
-# plt.plot(pois)
-# plt.show()
+@graph.stage('frame', files=['final_project_dataset.pkl'])
+def load_frame():
+    with open("final_project_dataset.pkl", "rb") as data_file:
+        dataset = pickle.load(data_file)
+
+    # brief check for outliers
+    salaries, pois = [], []
+    for k, v in dataset.items():
+        salaries.append(v['salary'])
+        pois.append(v['poi'] * 10000000)  # multiply for visual scale
 
-# ### Task 2: Remove outliers
-# extreme outlier with salary 25M +
-# check it's key name
-for k, v in dataset.items():
-    if v['salary'] != 'NaN' and v['salary'] > 10000000:
-        print(k)
+    # import matplotlib.pyplot as plt
+    # plt.figure(figsize=(30,5))
+    # plt.plot(salaries)
+    # plt.plot(pois)
+    # plt.show()
 
-# remove "TOTAL" row from the dataset
-del dataset['TOTAL']
+    # ### Task 2: Remove outliers
+    # extreme outlier with salary 25M +
+    # check it's key name
+    for k, v in dataset.items():
+        if v['salary'] != 'NaN' and v['salary'] > 10000000:
+            print(k)
 
-# get all dict keys
-all_features = list(list(dataset.items())[0][1].keys())
-print('All features:', all_features)
+    # remove "TOTAL" row from the dataset
+    del dataset['TOTAL']
 
-# email address is pretty much useless
-del all_features[all_features.index('email_address')]
+    # typed columns with real NaNs, one row per person
+    frame = from_dict(dataset)
+    print('All features:', list(frame.columns))
+    return frame
 
 # ### Task 3: Create new feature(s)
 
-# a feature to represent ratio of person's correspondence with poi to their total correspondence
-for k, v in dataset.items():
-    if any([v['from_poi_to_this_person']=='NaN', v['from_this_person_to_poi']=='NaN', v['to_messages']=='NaN', v['from_messages']=='NaN']):
-        v['interaction_with_poi'] = 'NaN'
-    else:
-        v['interaction_with_poi'] = (v['from_poi_to_this_person'] + v['from_this_person_to_poi']) / (v['to_messages'] + v['from_messages'])
-
-# ratio of deferral payments to total payments
-for k, v in dataset.items():
-    if any([v['deferral_payments']=='NaN', v['total_payments']=='NaN']):
-        v['payments_ratio'] = 'NaN'
-    else:
-        v['payments_ratio'] = v['deferral_payments'] / v['total_payments']
-
-# ratio of income to total payments
-for k, v in dataset.items():
-    if any([v['salary']=='NaN', v['total_payments']=='NaN', v['bonus']=='NaN']):
-        v['salary_payments_ratio'] = 'NaN'
-    else:
-        v['salary_payments_ratio'] = v['total_payments'] / v['salary'] + v['bonus']
-
-# once again pick all features
-all_features = list(list(dataset.items())[0][1].keys())
-del all_features[all_features.index('email_address')]
-
-# ensure poi will be in first place so lables and features could be succesfully formed with featureFormat
-my_features = ['poi'] + [f for f in all_features if f != 'poi']
-
-data = featureFormat(dataset, my_features, sort_keys = True)
-labels, features = targetFeatureSplit(data)
-
-# normalize
-features = preprocessing.scale(features)
-
-# check for best features using sklearn's SelectKBest
-# pick 5 features
-k_best = SelectKBest(k=5)
-k_best.fit(features, labels)
-
-# create a new feature list
-feature_list = ['poi']
-for f in sorted(zip(k_best.get_support(), my_features[1:]), reverse=True)[:5]:
-    print(f[1], f[0])
-    feature_list.append(f[1])
+
+@graph.stage('email', after=['frame'], files=['maildir'])
+def recount_email(frame):
+    # recount the email features from the mail corpus when it is at hand, a rerun only parses new files
+    if os.path.isdir('maildir'):
+        counts = email_features('maildir', frame, checkpoint='email_checkpoint.jsonl', workers=WORKERS)
+        frame = with_email_features(frame, counts)
+    return frame
+
+
+@graph.stage('features', after=['email'])
+def create_features(frame):
+    # interaction_with_poi, payments_ratio and salary_payments_ratio are vectorized
+    # expressions registered in poi_data, all computed in one pass
+    return add_features(frame)
+
+
+@graph.stage('selection', after=['features'], params={'k': 5})
+def select_features(frame, k):
+    # once again pick all features, email address is pretty much useless
+    all_features = [f for f in frame.columns if f != 'email_address']
+
+    # ensure poi will be in first place so lables and features could be succesfully formed with featureFormat
+    my_features = ['poi'] + [f for f in all_features if f != 'poi']
+
+    data = feature_matrix(frame, my_features, sort_keys = True)
+    labels, features = split_target(data)
+
+    # normalize
+    features = preprocessing.scale(features)
+
+    # check for best features using sklearn's SelectKBest
+    k_best = SelectKBest(k=k)
+    k_best.fit(features, labels)
+
+    # create a new feature list, the selected features ordered by their score
+    feature_list = ['poi']
+    selected = [(score, f) for score, f, chosen in zip(k_best.scores_, my_features[1:], k_best.get_support()) if chosen]
+    for score, f in sorted(selected, reverse=True):
+        print(f, score)
+        feature_list.append(f)
+    return my_features, feature_list
+
+
+@graph.stage('subset_search', after=['features', 'selection'])
+def search_subsets(frame, selection):
+    # the same selection for every k, done inside each of the stratified splits, and greedy
+    # forward and backward subsets, all scored like tester.py does
+    my_features, _ = selection
+    search = SubsetSearch(GaussianNB(), frame, my_features, workers=WORKERS)
+    search.sweep_k()
+    search.forward()
+    search.backward()
+    table = search.table()
+    print(table.head(10))
+    return table
 
 # ### Task 4: Try a varity of classifiers
 
-clf = GaussianNB()
-print(test_classifier(clf, dataset, feature_list))
+# every candidate is scored with tester.py's 1000 stratified splits in a stage of its own,
+# so changing one classifier only evaluates that one again
+candidates = [
+    ('GaussianNB', GaussianNB()),
+    ('LogisticRegression', LogisticRegression()),
+    ('RandomForest', RandomForestClassifier()),
+    ('MLP', MLPClassifier()),
+    ('KNN', KNeighborsClassifier()),
+    ('GradientBoosting', GradientBoostingClassifier()),
+    ('AdaBoost', AdaBoostClassifier()),
+]
 
-clf = LogisticRegression()
-print(test_classifier(clf, dataset, feature_list))
 
-clf = RandomForestClassifier()
-print(test_classifier(clf, dataset, feature_list))
+def evaluate(frame, selection, name, clf, seed):
+    # random classifiers get the seed, their folds run in other processes the global seed does not reach
+    if 'random_state' in clf.get_params():
+        clf = clone(clf).set_params(random_state=seed)
+    return compare([(name, clf)], frame, selection[1], workers=WORKERS)
 
-clf = MLPClassifier()
-print(test_classifier(clf, dataset, feature_list))
 
-clf = KNeighborsClassifier()
-print(test_classifier(clf, dataset, feature_list))
+for name, clf in candidates:
+    graph.stage('evaluate_' + name, after=['features', 'selection'], params={'name': name, 'clf': clf})(evaluate)
 
-clf = GradientBoostingClassifier()
-print(test_classifier(clf, dataset, feature_list))
 
-clf = AdaBoostClassifier()
-print(test_classifier(clf, dataset, feature_list))
+@graph.stage('comparison', after=['evaluate_' + name for name, _ in candidates])
+def compare_candidates(*evaluations):
+    table = pd.concat(evaluations)
+    print(table)
+    return table
 
 # ### Task 5: Tune your classifier to achieve better than .3 precision and recall
 
-# prepare the data for testing
-data = featureFormat(dataset, feature_list, sort_keys = True)
-y, X = targetFeatureSplit(data)
-
-# create parameter array - list of tuples with two numbers, representing probabilites, which sum up to 1
-priors = [(round(i / 20., 2), round(1 - (i / 20.), 2),) for i in range(1, 20)]
-print('Parameter grid:', priors)
-
-# split data into training and testing sets
-X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.33)
-
-parameters = {'priors': priors}
-scores = ['precision', 'recall']
-
-# perform GridSearchCV - results may vary due to random nature
-for score in scores:
-    print("# Tuning hyper-parameters for %s" % score)
-    clf = GridSearchCV(GaussianNB(), parameters, cv=10, scoring='%s_macro' % score)
-    clf.fit(X_train, y_train)
-    print("Best parameters set found on development set:")
-    print(clf.best_params_)
-    print("Grid scores on development set:")
-    means = clf.cv_results_['mean_test_score']
-    stds = clf.cv_results_['std_test_score']
-    for mean, std, params in zip(means, stds, clf.cv_results_['params']):
-        print("%0.3f (+/-%0.03f) for %r" % (mean, std * 2, params))
-    print("\n\nDetailed classification report:\n")
-    print("The model is trained on the full development set.")
-    print("The scores are computed on the full evaluation set.\n")
-    y_pred = clf.predict(X_test)
-    print(classification_report(y_test, y_pred))
+
+@graph.stage('tuning', after=['features', 'selection'])
+def tune(frame, selection, seed):
+    # prepare the data for testing
+    data = feature_matrix(frame, selection[1], sort_keys = True)
+    y, X = split_target(data)
+
+    # create parameter array - list of tuples with two numbers, representing probabilites, which sum up to 1
+    priors = [(round(i / 20., 2), round(1 - (i / 20.), 2),) for i in range(1, 20)]
+    print('Parameter grid:', priors)
+
+    # split data into training and testing sets, seeded so every run tunes on the same split
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.33, random_state=seed)
+
+    parameters = {'priors': priors}
+
+    # one search scores precision and recall together on the same 10 folds, in parallel
+    search = grid_search(GaussianNB(), parameters, X_train, y_train)
+    for score in SCORERS:
+        print("# Tuning hyper-parameters for %s" % score)
+        print("Best parameters set found on development set:")
+        print(best_params(search, score))
+        print("Grid scores on development set:")
+        for mean, std, params in grid_scores(search, score):
+            print("%0.3f (+/-%0.03f) for %r" % (mean, std * 2, params))
+        print("\n\nDetailed classification report:\n")
+        print("The model is trained on the full development set.")
+        print("The scores are computed on the full evaluation set.\n")
+        y_pred = refit(search, score, X_train, y_train).predict(X_test)
+        print(classification_report(y_test, y_pred))
+    return dict((score, best_params(search, score)) for score in SCORERS)
 
 # #### However In the real world scenario predict_proba might be used for classifying classes with different error significance
 
-clf = GaussianNB(priors=(0.25, 0.75))
-test_classifier(clf, dataset, feature_list)
 
-dump_classifier_and_data(clf, dataset, feature_list)
+@graph.stage('final', after=['features', 'selection'], params={'clf': GaussianNB(priors=(0.25, 0.75))})
+def final_classifier(frame, selection, clf):
+    feature_list = selection[1]
+    test_classifier(clf, frame, feature_list, workers=WORKERS)
+
+    # test_classifier only fits copies of clf, the one dumped is fitted on all the data
+    y, X = split_target(feature_matrix(frame, feature_list, sort_keys = True))
+    return clone(clf).fit(X, y)
 
 # #### A pipeline would look like this
 
-from sklearn.feature_selection import SelectKBest
-from sklearn.feature_selection import f_regression
-from sklearn.pipeline import Pipeline
 
-anova_filter = SelectKBest(f_regression, k=5)
-clf = GaussianNB()
-anova_gnb = Pipeline([('anova', anova_filter), ('gnb', clf)])
-anova_gnb.set_params(gnb__priors=(0.25, 0.75))
+@graph.stage('pipeline', after=['features', 'selection'])
+def evaluate_pipeline(frame, selection):
+    anova_gnb = anova_pipeline(k=5)
+    anova_gnb.set_params(gnb__priors=(0.25, 0.75))
+
+    return test_classifier(anova_gnb, frame, selection[1], workers=WORKERS)
+
+
+if __name__ == '__main__':
+    results = graph.run()
+
+    clf = results['final']
+    frame = results['features']
+    feature_list = results['selection'][1]
 
-test_classifier(anova_gnb, dataset, feature_list)
+    # tester.py still works on the dict of dicts
+    dataset = to_dict(frame)
+    dump_classifier_and_data(clf, dataset, feature_list)
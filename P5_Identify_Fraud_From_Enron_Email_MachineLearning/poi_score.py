@@ -0,0 +1,189 @@
+# coding: utf-8
+
+"""
+Scoring of new people with the model written by dump_classifier_and_data.
+
+    scorer = PoiScorer.load('.')
+    scorer.score(records)                 # probability of being a poi, a Series per record
+    scorer.partial_fit(records, labels)   # refine the model with labeled records
+    scorer.save('.')
+
+The classifier and feature list are loaded once and stay in memory. records
+are a DataFrame like poi_data.from_dict() builds, a dict of dicts like
+my_dataset.pkl or a list of such dicts, one per person; derived features of
+the feature list that the records lack are computed with poi_data. Missing
+values count as 0, as featureFormat does, but no record is dropped, and
+records keep the order they are given in: scores of a dict of dicts are
+indexed by person in the dict's order.
+
+    python poi_score.py
+
+checks that order, then times score() and partial_fit() for batches of 1 to
+100k records.
+"""
+
+from __future__ import division, print_function
+
+import copy
+import os
+import pickle
+import time
+import warnings
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+from sklearn.exceptions import InconsistentVersionWarning
+
+from poi_data import DERIVED_FEATURES, add_features, feature_matrix, from_dict, load_dataset, to_dict
+
+# the files of dump_classifier_and_data
+CLF_PICKLE = 'my_classifier.pkl'
+DATASET_PICKLE = 'my_dataset.pkl'
+FEATURE_LIST_PICKLE = 'my_feature_list.pkl'
+
+BATCH_SIZES = (1, 10, 100, 1000, 10000, 100000)
+
+
+def _load_pickle(path):
+    with open(path, 'rb') as f:
+        # the classifier of the original project was pickled by Python 2 with NumPy arrays in it
+        return pickle.load(f, encoding='latin1')
+
+
+def _current(clf):
+    """ Unfitted estimator of clf's class with its parameters, defaults for parameters added since it was pickled. """
+    names = type(clf)().get_params(deep=False)
+    return type(clf)(**dict((name, getattr(clf, name)) for name in names if hasattr(clf, name)))
+
+
+class PoiScorer(object):
+    """ A fitted classifier and its feature list, scoring batches of records. """
+
+    def __init__(self, clf, feature_list):
+        self.clf = clf
+        self.feature_list = list(feature_list)
+        self.features = [f for f in self.feature_list if f != 'poi']
+        self.derived = [f for f in self.features if f in DERIVED_FEATURES]
+
+    @classmethod
+    def load(cls, directory='.'):
+        """
+        Scorer of the artifact in directory. A classifier pickled by another
+        version of scikit-learn may be missing attributes the installed one
+        needs, so it is fitted again with the same parameters on the dataset
+        of the artifact.
+        """
+        feature_list = _load_pickle(os.path.join(directory, FEATURE_LIST_PICKLE))
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always', InconsistentVersionWarning)
+            clf = _load_pickle(os.path.join(directory, CLF_PICKLE))
+        scorer = cls(clf, feature_list)
+        if any(issubclass(w.category, InconsistentVersionWarning) for w in caught):
+            frame = load_dataset(os.path.join(directory, DATASET_PICKLE))
+            data = feature_matrix(frame, scorer.feature_list)
+            scorer.clf = _current(clf).fit(data[:, 1:], data[:, 0])
+        return scorer
+
+    def save(self, directory='.'):
+        """ Writes the classifier and feature list back, the dataset pickle is left alone. """
+        for name, obj in ((CLF_PICKLE, self.clf), (FEATURE_LIST_PICKLE, self.feature_list)):
+            with open(os.path.join(directory, name), 'wb') as f:
+                pickle.dump(obj, f)
+
+    def frame(self, records):
+        """
+        DataFrame of records in the order given, indexed by person for a dict
+        of dicts, with the derived features of the feature list added.
+        """
+        if isinstance(records, dict):
+            # from_dict sorts people by name, callers expect their own order back
+            records = from_dict(records).reindex(list(records))
+        elif not isinstance(records, pd.DataFrame):
+            records = pd.DataFrame.from_records(records).replace('NaN', np.nan)
+        missing = [f for f in self.derived if f not in records.columns]
+        if missing:
+            records = add_features(records, missing)
+        return records
+
+    def transform(self, records):
+        """
+        Feature matrix of records, rows in the order given and columns in the
+        order of the feature list, missing values as 0.
+        """
+        return self.frame(records)[self.features].to_numpy(dtype=np.float64, na_value=0.0)
+
+    def score(self, records):
+        """ Series of the probability of being a poi of every record, indexed as frame(records) is. """
+        records = self.frame(records)
+        scores = self.clf.predict_proba(self.transform(records))[:, list(self.clf.classes_).index(1)]
+        return pd.Series(scores, index=records.index, name='poi_probability')
+
+    def predict(self, records):
+        """ Series of the predicted poi label of every record, indexed as frame(records) is. """
+        records = self.frame(records)
+        return pd.Series(self.clf.predict(self.transform(records)), index=records.index, name='poi')
+
+    def partial_fit(self, records, labels):
+        """
+        Updates the classifier with labeled records instead of fitting it again
+        on everything. labels are in the order of records.
+        """
+        if not hasattr(self.clf, 'partial_fit'):
+            raise ValueError('%s cannot be updated incrementally' % type(self.clf).__name__)
+        self.clf.partial_fit(self.transform(records), np.asarray(labels, dtype=np.float64))
+        return self
+
+
+def sample_records(frame, n, seed=0):
+    """ n records drawn with replacement from frame, as new people to score. """
+    rows = np.random.RandomState(seed).randint(len(frame), size=n)
+    return frame.iloc[rows].reset_index(drop=True)
+
+
+def check_order(scorer, frame, n=5):
+    """
+    Fails unless the scores of a dict of dicts of n people, in reverse name
+    order, come back in that order and match the scores of each person alone.
+    """
+    dataset = to_dict(frame.iloc[:n])
+    records = OrderedDict((name, dataset[name]) for name in sorted(dataset, reverse=True))
+    scores = scorer.score(records)
+    if list(scores.index) != list(records):
+        raise AssertionError('scores are in the order %s, records in %s' % (list(scores.index), list(records)))
+    for name in records:
+        alone = scorer.score({name: records[name]})[name]
+        if not np.isclose(scores[name], alone):
+            raise AssertionError('%s scored %r in a batch and %r alone' % (name, scores[name], alone))
+    return scores
+
+
+def benchmark(scorer, frame, sizes=BATCH_SIZES, repeats=5):
+    """
+    Best of repeats latency and throughput of score() and partial_fit() per
+    batch size, on records sampled from frame. partial_fit runs on a copy of
+    the classifier so the scorer is left as it was.
+    """
+    rows = []
+    for size in sizes:
+        records = sample_records(frame, size)
+        labels = records['poi'].to_numpy()
+        updated = PoiScorer(copy.deepcopy(scorer.clf), scorer.feature_list)
+        for operation, run in (('score', lambda: scorer.score(records)),
+                               ('partial_fit', lambda: updated.partial_fit(records, labels))):
+            best = float('inf')
+            for _ in range(repeats):
+                start = time.perf_counter()
+                run()
+                best = min(best, time.perf_counter() - start)
+            rows.append({'operation': operation, 'batch': size, 'latency_ms': best * 1000,
+                         'records_per_s': size / best})
+    return pd.DataFrame(rows, columns=['operation', 'batch', 'latency_ms', 'records_per_s'])
+
+
+if __name__ == '__main__':
+    scorer = PoiScorer.load('.')
+    frame = load_dataset(DATASET_PICKLE)
+    pd.set_option('display.width', 120)
+    print(check_order(scorer, frame).to_string())
+    print(benchmark(scorer, frame).to_string(index=False))
@@ -0,0 +1,201 @@
+# coding: utf-8
+
+"""
+Feature subset search on the tester.py metrics.
+
+    search = SubsetSearch(GaussianNB(), frame, ['poi'] + candidates)
+    search.sweep_k()       # SelectKBest for every k, selected inside each fold
+    search.forward()       # greedy forward selection
+    search.backward()      # greedy backward elimination
+    search.table()         # every subset evaluated, best first
+
+The univariate scores of the candidates are computed once per fold, on the
+training part only, and kept per digest of the data. Every subset is
+evaluated once on the same stratified shuffle splits, and forward and
+backward selection share what the other already evaluated. Other classifiers
+are fitted per subset and fold with poi_eval.run_tasks, on a pool if workers
+asks for one; GaussianNB is fitted once per fold for all subsets, so sweeping
+k from 1 to all features costs little more than evaluating one k.
+
+All subsets are evaluated on the rows of the full candidate matrix: people
+whose candidate features are all missing are dropped once, not per subset.
+"""
+
+from __future__ import division, print_function
+
+import hashlib
+import time
+
+import numpy as np
+import pandas as pd
+from sklearn.feature_selection import f_classif
+from sklearn.naive_bayes import GaussianNB
+
+from poi_data import feature_matrix, split_target
+from poi_eval import COUNTS, RANDOM_STATE, chunk_tasks, confusion_counts, make_splits, run_tasks, summarize
+
+# fewer splits than tester.py: a search evaluates many subsets, the winners can be checked with test_classifier
+SEARCH_FOLDS = 100
+
+# metric the greedy searches maximize
+METRIC = 'f1'
+
+SEARCH_COLUMNS = ['method', 'k', 'features', 'accuracy', 'precision', 'recall', 'f1', 'f2']
+
+# (digest of features, labels and training indices, score function) -> scores per fold
+_fold_scores = {}
+
+
+def fold_scores(features, labels, splits, score_func=f_classif):
+    """ Univariate scores of every column on the training part of every split, one row per split. """
+    digest = hashlib.sha256(np.ascontiguousarray(features).tobytes())
+    digest.update(np.ascontiguousarray(labels).tobytes())
+    digest.update(np.concatenate([train for train, _ in splits]).tobytes())
+    key = (digest.hexdigest(), score_func.__module__, score_func.__name__)
+    if key not in _fold_scores:
+        rows = []
+        for train, _ in splits:
+            result = score_func(features[train], labels[train])
+            rows.append(result[0] if isinstance(result, tuple) else result)
+        _fold_scores[key] = np.array(rows, dtype=np.float64)
+    return _fold_scores[key]
+
+
+def rank_columns(scores):
+    """ Column indices of every row ordered by decreasing score, undefined scores last. """
+    return np.argsort(-np.nan_to_num(scores, nan=-np.inf), axis=1, kind='stable')
+
+
+def evaluate_gaussian_nb(clf, features, labels, splits, candidates):
+    """
+    run_tasks() totals of GaussianNB for the (key, columns per split) of
+    candidates, from one fit per split. Naive Bayes treats the features
+    independently, so the class means and variances of all columns serve every
+    candidate; only the variance smoothing, var_smoothing times the largest
+    variance of the chosen columns, is worked out per candidate as
+    GaussianNB.fit does. Gives the same predictions as fitting GaussianNB on
+    each candidate's columns.
+    """
+    totals = dict((key, dict.fromkeys(COUNTS + ['fit_s', 'predict_s'], 0)) for key, _ in candidates)
+    for i, (train, test) in enumerate(splits):
+        start = time.perf_counter()
+        x, y, test_x = features[train], labels[train], features[test]
+        classes = np.unique(y)
+        means = np.array([x[y == c].mean(axis=0) for c in classes])
+        variances = np.array([x[y == c].var(axis=0) for c in classes])
+        counts = np.array([np.sum(y == c) for c in classes])
+        log_priors = np.log(clf.priors if clf.priors is not None else counts / counts.sum())
+        spread = x.var(axis=0)
+        fit_s = time.perf_counter() - start
+        for key, columns in candidates:
+            start = time.perf_counter()
+            columns = np.asarray(columns[i])
+            var = variances[:, columns] + clf.var_smoothing * spread[columns].max()
+            diff = test_x[:, None, columns] - means[None, :, columns]
+            joint = log_priors - 0.5 * np.log(2 * np.pi * var).sum(axis=1) - 0.5 * (diff ** 2 / var).sum(axis=2)
+            total = totals[key]
+            for name, n in confusion_counts(labels[test], classes[np.argmax(joint, axis=1)]).items():
+                total[name] += n
+            total['fit_s'] += fit_s
+            total['predict_s'] += time.perf_counter() - start
+    return totals
+
+
+class SubsetSearch(object):
+    """ Evaluations of subsets of the features of feature_list (after 'poi') with clf. """
+
+    def __init__(self, clf, frame, feature_list, folds=SEARCH_FOLDS, random_state=RANDOM_STATE,
+                 workers=1, score_func=f_classif, metric=METRIC):
+        self.clf = clf
+        self.names = [f for f in feature_list if f != 'poi']
+        self.folds = folds
+        self.workers = workers
+        self.metric = metric
+        self.labels, self.features = split_target(feature_matrix(frame, ['poi'] + self.names))
+        self.splits = make_splits(self.labels, folds, random_state)
+        self.order = rank_columns(fold_scores(self.features, self.labels, self.splits, score_func))
+        # (method, columns) -> result, columns a tuple for fixed subsets and k for SelectKBest
+        self.results = {}
+
+    def _run(self, method, candidates):
+        """
+        Evaluates the (key, columns per fold) of candidates not evaluated yet,
+        in one run_tasks() call, or from one fit per fold for GaussianNB.
+        """
+        todo = [(key, columns) for key, columns in candidates if (method, key) not in self.results]
+        if todo:
+            if type(self.clf) is GaussianNB:
+                totals = evaluate_gaussian_nb(self.clf, self.features, self.labels, self.splits, todo)
+            else:
+                tasks = [task for key, columns in todo for task in chunk_tasks(key, self.clf, self.folds, columns)]
+                totals = run_tasks(tasks, self.features, self.labels, self.splits, self.workers)
+            for key, _ in todo:
+                self.results[method, key] = summarize(totals[key], self.folds)
+        return [self.results[method, key] for key, _ in candidates]
+
+    def _subsets(self, subsets):
+        """ Results of fixed column subsets, each a sorted tuple. """
+        return self._run('subset', [(subset, [list(subset)] * self.folds) for subset in subsets])
+
+    def _score(self, result):
+        value = result[self.metric]
+        return -np.inf if np.isnan(value) else value
+
+    def sweep_k(self, ks=None):
+        """ SelectKBest followed by clf for every k in ks, 1 to all features by default. """
+        ks = range(1, len(self.names) + 1) if ks is None else ks
+        return self._run('k_best', [(k, self.order[:, :k]) for k in ks])
+
+    def forward(self, max_features=None):
+        """
+        Greedy forward selection: starting from nothing, adds the feature that
+        improves the metric most, until max_features or no feature improves it.
+        Returns the chosen subsets in order.
+        """
+        max_features = len(self.names) if max_features is None else max_features
+        chosen, best, path = (), -np.inf, []
+        while len(chosen) < max_features:
+            candidates = [tuple(sorted(chosen + (c,))) for c in range(len(self.names)) if c not in chosen]
+            results = self._subsets(candidates)
+            i = int(np.argmax([self._score(r) for r in results]))
+            if self._score(results[i]) <= best:
+                break
+            chosen, best = candidates[i], self._score(results[i])
+            path.append(chosen)
+        return path
+
+    def backward(self, min_features=1):
+        """
+        Greedy backward elimination: starting from all features, removes the
+        one whose removal leaves the best metric, while that does not make it
+        worse and more than min_features are left. Returns the subsets in order.
+        """
+        chosen = tuple(range(len(self.names)))
+        best = self._score(self._subsets([chosen])[0])
+        path = [chosen]
+        while len(chosen) > min_features:
+            candidates = [tuple(c for c in chosen if c != drop) for drop in chosen]
+            results = self._subsets(candidates)
+            i = int(np.argmax([self._score(r) for r in results]))
+            if self._score(results[i]) < best:
+                break
+            chosen, best = candidates[i], self._score(results[i])
+            path.append(chosen)
+        return path
+
+    def table(self):
+        """
+        Every evaluation so far, best metric first: the method, the number of
+        features, the features of a fixed subset (the k best are chosen per
+        fold), tester.py's metrics and the confusion counts.
+        """
+        rows = []
+        for (method, key), result in self.results.items():
+            if method == 'k_best':
+                k, features = key, None
+            else:
+                k, features = len(key), ', '.join(self.names[c] for c in key)
+            rows.append(dict(result, method=method, k=k, features=features))
+        table = pd.DataFrame(rows, columns=SEARCH_COLUMNS + COUNTS)
+        return table.sort_values([self.metric, 'k'], ascending=[False, True], na_position='last',
+                                 kind='stable').reset_index(drop=True)
@@ -0,0 +1,196 @@
+# coding: utf-8
+
+"""
+Stage graph with content-addressed caching of every stage's output.
+
+    graph = StageGraph(seed=42)
+
+    @graph.stage('frame', files=['final_project_dataset.pkl'])
+    def frame():
+        ...
+
+    @graph.stage('features', after=['frame'], params={'k': 5})
+    def features(frame, k):
+        ...
+
+    results = graph.run()
+
+A stage gets the outputs of the stages it comes after as arguments, in order,
+its params as keyword arguments and the graph's seed if it has a seed
+argument. Its key is a digest of its name, its source, the sources of the
+local poi_* modules, the versions of Python, scikit-learn, NumPy and pandas,
+its params, the seed, the contents of its files and the keys of the stages
+before it. Outputs are pickled in the cache directory
+under that key together with everything the stage printed, so a stage only
+runs again when something it depends on changed, and a cached stage prints
+the same output as when it ran. A changed stage invalidates the stages after
+it through their keys.
+
+Before a stage runs, random and numpy.random are seeded with the seed, so
+unseeded randomness gives the same result on every run. Every stage logs
+whether it ran or came from the cache and how long it took to stderr.
+"""
+
+from __future__ import print_function
+
+import hashlib
+import inspect
+import io
+import os
+import pickle
+import random
+import sys
+from collections import OrderedDict
+from contextlib import redirect_stdout
+from timeit import default_timer
+
+import numpy as np
+import pandas as pd
+import sklearn
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.poi_stages')
+
+SEED = 42
+
+# local modules whose source is part of every key
+MODULE_PREFIX = 'poi_'
+
+# part of every key too: outputs, fitted estimators among them, may not carry over to other versions
+VERSIONS = (sys.version_info[:2], sklearn.__version__, np.__version__, pd.__version__)
+
+
+def describe(value):
+    """ Stable text of a parameter, estimators by class and parameters as poi_eval.cache_key does. """
+    if hasattr(value, 'get_params'):
+        params = sorted((key, describe(v)) for key, v in value.get_params(deep=False).items())
+        return repr((type(value).__module__, type(value).__name__, params))
+    if isinstance(value, (list, tuple)):
+        return '%s(%s)' % (type(value).__name__, ', '.join(describe(v) for v in value))
+    if isinstance(value, dict):
+        return 'dict(%s)' % ', '.join('%r: %s' % (k, describe(value[k])) for k in sorted(value))
+    return repr(value)
+
+
+def input_digest(path):
+    """
+    Digest of an input file's contents. A directory, such as a mail corpus,
+    is summed up by the names, sizes and modification times of its files.
+    """
+    digest = hashlib.sha256()
+    if os.path.isdir(path):
+        for directory, subdirectories, names in os.walk(path):
+            subdirectories.sort()
+            for name in sorted(names):
+                stat = os.stat(os.path.join(directory, name))
+                digest.update(('%s %d %d\n' % (os.path.relpath(os.path.join(directory, name), path),
+                                               stat.st_size, stat.st_mtime_ns)).encode('utf-8'))
+    elif os.path.exists(path):
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+    else:
+        digest.update(b'missing')
+    return digest.hexdigest()
+
+
+def modules_digest():
+    """ Digest of the sources of the poi_* modules loaded, the library code every stage relies on. """
+    digest = hashlib.sha256()
+    for name in sorted(sys.modules):
+        path = getattr(sys.modules[name], '__file__', None)
+        if name.startswith(MODULE_PREFIX) and path and path.endswith('.py'):
+            with open(path, 'rb') as f:
+                digest.update(name.encode('utf-8') + b'\0' + f.read())
+    return digest.hexdigest()
+
+
+class StageGraph(object):
+    """ Stages in the order they were added, each after the stages its inputs come from. """
+
+    def __init__(self, seed=SEED, cache_dir=CACHE_DIR, stream=None):
+        self.seed = seed
+        self.cache_dir = cache_dir
+        self.stream = stream if stream is not None else sys.stderr
+        self.stages = OrderedDict()
+        self.timings = []
+
+    def stage(self, name, after=(), params=None, files=()):
+        """ Decorator adding the function as stage name. """
+        def add(func):
+            for previous in after:
+                if previous not in self.stages:
+                    raise ValueError('stage %s comes after %s, which is not defined before it' % (name, previous))
+            self.stages[name] = {'func': func, 'after': list(after), 'params': dict(params or {}),
+                                 'files': list(files)}
+            return func
+        return add
+
+    def _key(self, name, keys, modules):
+        stage = self.stages[name]
+        digest = hashlib.sha256()
+        digest.update(repr((name, inspect.getsource(stage['func']), modules, VERSIONS, describe(stage['params']),
+                            self.seed, [input_digest(path) for path in stage['files']],
+                            [keys[previous] for previous in stage['after']])).encode('utf-8'))
+        return digest.hexdigest()
+
+    def _path(self, name, key):
+        return os.path.join(self.cache_dir, '%s-%s.pkl' % (name, key))
+
+    def _load(self, name, key):
+        if self.cache_dir is None or not os.path.exists(self._path(name, key)):
+            return None
+        with open(self._path(name, key), 'rb') as f:
+            return pickle.load(f)
+
+    def _store(self, name, key, entry):
+        if self.cache_dir is None:
+            return
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        # written under a temporary name first so a reader never sees half a file
+        path = self._path(name, key)
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+
+    def _needed(self, targets):
+        """ Names of the targets and every stage before them, in order. """
+        if targets is None:
+            return list(self.stages)
+        needed, todo = set(), list(targets)
+        while todo:
+            name = todo.pop()
+            if name not in needed:
+                needed.add(name)
+                todo.extend(self.stages[name]['after'])
+        return [name for name in self.stages if name in needed]
+
+    def run(self, targets=None):
+        """ Runs or loads the targets, all stages by default, and the stages before them. Returns name -> output. """
+        modules = modules_digest()
+        keys, results = {}, {}
+        self.timings = []
+        for name in self._needed(targets):
+            stage = self.stages[name]
+            start = default_timer()
+            keys[name] = key = self._key(name, keys, modules)
+            entry = self._load(name, key)
+            cached = entry is not None
+            if not cached:
+                func = stage['func']
+                kwargs = dict(stage['params'])
+                if 'seed' in inspect.signature(func).parameters:
+                    kwargs['seed'] = self.seed
+                random.seed(self.seed)
+                np.random.seed(self.seed)
+                output = io.StringIO()
+                with redirect_stdout(output):
+                    result = func(*[results[previous] for previous in stage['after']], **kwargs)
+                entry = {'result': result, 'output': output.getvalue()}
+                self._store(name, key, entry)
+            sys.stdout.write(entry['output'])
+            results[name] = entry['result']
+            seconds = default_timer() - start
+            self.timings.append({'stage': name, 'cached': cached, 'seconds': seconds, 'key': key})
+            print('%-28s %-6s %8.2f s' % (name, 'cached' if cached else 'ran', seconds), file=self.stream)
+        return results
@@ -0,0 +1,152 @@
+# coding: utf-8
+
+"""
+Memory-mapped columnar store of the Enron dataset.
+
+    write_store(load_dataset('my_dataset.pkl'), 'my_dataset.poi')
+    store = ColumnStore('my_dataset.poi')
+    labels, features = split_target(store.feature_matrix(feature_list))
+
+A store is a directory with one .npy file per column and a schema.json
+listing the columns and their types. Numeric columns are float64 with NaN for
+missing values, poi is bool. Text columns, the person index among them, are
+utf-8 bytes with an int64 offset per row, an empty string standing for a
+missing value. Opening a store maps the files without reading them, so it
+takes the same time for any number of people, and only the pages of the
+columns actually used are ever read.
+
+from_pickle() and to_pickle() convert from and to the dict of dicts format of
+final_project_dataset.pkl and my_dataset.pkl.
+"""
+
+from __future__ import division
+
+import json
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+
+from poi_data import TEXT_FEATURES, load_dataset, to_dict
+
+SCHEMA_FILE = 'schema.json'
+STORE_VERSION = 1
+
+# name of the person index, stored as a text column
+INDEX = 'name'
+
+
+def _column_file(path, name, part=None):
+    return os.path.join(path, name + ('.%s' % part if part else '') + '.npy')
+
+
+def _write_text(path, name, values):
+    encoded = [b'' if v is None else v.encode('utf-8') for v in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(v) for v in encoded], out=offsets[1:])
+    np.save(_column_file(path, name, 'offsets'), offsets)
+    np.save(_column_file(path, name, 'bytes'), np.frombuffer(b''.join(encoded), dtype=np.uint8))
+
+
+def write_store(frame, path):
+    """
+    Writes the frame of poi_data.from_dict() to the store directory path,
+    rows sorted by person as featureFormat sorts them.
+    """
+    frame = frame.sort_index()
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    columns = []
+    _write_text(path, INDEX, frame.index)
+    for name in frame.columns:
+        values = frame[name]
+        if name in TEXT_FEATURES or values.dtype == object:
+            _write_text(path, name, [None if v is None or v != v else v for v in values])
+            kind = 'text'
+        elif values.dtype == bool:
+            np.save(_column_file(path, name), values.to_numpy())
+            kind = 'bool'
+        else:
+            np.save(_column_file(path, name), values.to_numpy(dtype=np.float64))
+            kind = 'float64'
+        columns.append({'name': name, 'type': kind})
+    # the schema goes last, a store without one was not written completely
+    with open(os.path.join(path, SCHEMA_FILE), 'w') as f:
+        json.dump({'version': STORE_VERSION, 'rows': len(frame), 'columns': columns}, f, indent=2)
+
+
+class ColumnStore(object):
+    """ Read-only view of a store directory, columns memory-mapped on first use. """
+
+    def __init__(self, path):
+        with open(os.path.join(path, SCHEMA_FILE)) as f:
+            schema = json.load(f)
+        if schema['version'] != STORE_VERSION:
+            raise ValueError('%s is a version %s store, expected %s' % (path, schema['version'], STORE_VERSION))
+        self.path = path
+        self.rows = schema['rows']
+        self.types = dict((column['name'], column['type']) for column in schema['columns'])
+        self.columns = [column['name'] for column in schema['columns']]
+        self._maps = {}
+
+    def _map(self, name, part=None):
+        key = (name, part)
+        if key not in self._maps:
+            self._maps[key] = np.load(_column_file(self.path, name, part), mmap_mode='r')
+        return self._maps[key]
+
+    def column(self, name):
+        """ Numeric or bool column as a read-only memory-mapped array, a text column as an object array. """
+        if name == INDEX or self.types[name] == 'text':
+            return self.text(name)
+        return self._map(name)
+
+    def text(self, name):
+        """ Decoded values of the text column name, None where missing. """
+        offsets, data = self._map(name, 'offsets'), self._map(name, 'bytes')
+        raw = data.tobytes()
+        values = np.empty(self.rows, dtype=object)
+        for i, (start, stop) in enumerate(zip(offsets[:-1].tolist(), offsets[1:].tolist())):
+            values[i] = raw[start:stop].decode('utf-8') if stop > start else None
+        return values
+
+    def names(self):
+        return self.text(INDEX)
+
+    def feature_matrix(self, features, remove_all_zeroes=True):
+        """
+        Same array as poi_data.feature_matrix(frame, features), built column by
+        column from the mapped files: NaN becomes 0, and rows whose features
+        other than poi are all 0 are dropped.
+        """
+        rows, n_rows = slice(None), self.rows
+        if remove_all_zeroes:
+            # the kept rows are found first so only they are ever copied out of the mapped columns
+            rows = np.zeros(self.rows, dtype=bool)
+            for name in (features[1:] if features[0] == 'poi' else features):
+                column = self._map(name)
+                rows |= (column != 0) & (column == column)
+            n_rows = int(rows.sum())
+        data = np.empty((n_rows, len(features)))
+        for i, name in enumerate(features):
+            data[:, i] = self._map(name)[rows]
+        return np.nan_to_num(data, copy=False, nan=0.0)
+
+    def to_frame(self, columns=None):
+        """ DataFrame of the columns given, all by default, indexed by person as poi_data.from_dict() builds it. """
+        columns = self.columns if columns is None else columns
+        data = dict((name, self.column(name)) for name in columns)
+        return pd.DataFrame(data, columns=columns, index=pd.Index(self.names(), name=INDEX))
+
+
+def from_pickle(pickle_path, path):
+    """ Converts the dict of dicts pickle at pickle_path into a store at path. """
+    write_store(load_dataset(pickle_path), path)
+    return ColumnStore(path)
+
+
+def to_pickle(store, pickle_path):
+    """ Writes store as a dict of dicts pickle with 'NaN' for missing values, for tester.py. """
+    with open(pickle_path, 'wb') as f:
+        pickle.dump(to_dict(store.to_frame()), f)